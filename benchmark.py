@@ -0,0 +1,316 @@
+"""
+    offline benchmark of the coordinate pipeline on generated fixtures, no RigData21/GISCoreData needed:
+    synthetic records for the Texas, PLS, Alberta DLS and British Columbia TS models, reference shapes
+    (square and irregular PLSS sections, DLS township grids, Texas abstracts with many vertices, API regions)
+    served by a fixture backend in place of the GIS SQL Server (see lookup.set_backend)
+
+        python benchmark.py                                  # 2000 records, results in benchmark.json
+        python benchmark.py --records 10000 --output runs/2017-06-01.json
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import datetime
+import platform
+import subprocess
+from contextlib import contextmanager
+from shapely import wkb
+from shapely.geometry import Point, Polygon, box
+
+import lookup
+import quality
+import memo
+from utils import CornerDetector, calc_point_from_offsets, calc_points_from_offsets, transform
+from router import Rec, define_type, process_record
+
+
+METERS_PER_MILE = 1609.344
+
+# fixture regions: state code, (lon, lat) of the area the sites are generated in
+REGIONS = [
+    ('TX', (-100.5, 31.5)),
+    ('ND', (-102.5, 47.5)),
+    ('AB', (-114.0, 52.5)),
+    ('BC', (-122.0, 56.5)),
+]
+
+
+class Fixture(object):
+    # plain attribute holder standing in for the ORM objects of a record
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class FixtureBackend():
+    """
+        answers the reference shape lookups from the generated fixtures, as WKB like the GIS SQL Server
+    """
+    def __init__(self):
+        self.blobs = {}
+        self.fetches = 0
+
+    def add(self, lookup, geometry):
+        self.blobs[lookup.key()] = geometry.wkb
+
+    def fetch_geometry(self, table, where_clause):
+        self.fetches += 1
+        blob = self.blobs.get(lookup.cache_key(table, where_clause))
+        return (wkb.loads(blob), len(blob)) if blob else (None, 0)
+
+
+def mile_wm (lat):
+    # one mile in web mercator meters at the latitude
+    return METERS_PER_MILE / math.cos(lat * math.pi / 180.0)
+
+
+def square_section (x, y, side, vertices_per_side=10):
+    # section with the intermediate vertices of the survey lines along its sides
+    steps = [float(i) / vertices_per_side for i in range(vertices_per_side)]
+    ring = [(x + side * t, y) for t in steps] + [(x + side, y + side * t) for t in steps] + \
+           [(x + side * (1 - t), y + side) for t in steps] + [(x, y + side * (1 - t)) for t in steps]
+    return Polygon(ring)
+
+
+def irregular_section (x, y, side, rnd, vertices_per_side=10):
+    # skewed corners and slightly wobbly sides, like the sections along correction lines
+    corners = [(x + rnd.uniform(-0.05, 0.05) * side + dx * side, y + rnd.uniform(-0.05, 0.05) * side + dy * side) for dx, dy in ((0, 0), (1, 0), (1, 1), (0, 1))]
+    ring = []
+    for (x1, y1), (x2, y2) in zip(corners, corners[1:] + corners[:1]):
+        for i in range(vertices_per_side):
+            t = float(i) / vertices_per_side
+            ring.append((x1 + (x2 - x1) * t + rnd.uniform(-2, 2), y1 + (y2 - y1) * t + rnd.uniform(-2, 2)))
+    return Polygon(ring)
+
+
+def texas_abstract (x, y, rnd, vertices=1000):
+    # irregular abstract: a quadrilateral of 0.5 to 2 miles with many digitized vertices along its sides
+    width, height = rnd.uniform(0.5, 2.0) * mile_wm(31.5), rnd.uniform(0.5, 2.0) * mile_wm(31.5)
+    return Polygon([(x + width * px + rnd.uniform(-3, 3), y + height * py + rnd.uniform(-3, 3)) for px, py in _outline(vertices // 4)])
+
+
+def _outline (per_side):
+    steps = [float(i) / per_side for i in range(per_side)]
+    return [(t, 0.0) for t in steps] + [(1.0, t) for t in steps] + [(1.0 - t, 1.0) for t in steps] + [(0.0, 1.0 - t) for t in steps]
+
+
+def build_fixtures (records, seed=0):
+    """
+        returns ([Rec], FixtureBackend, [section polygons]) for about `records` records spread over the regions
+    """
+    rnd = random.Random(seed)
+    backend = FixtureBackend()
+    recs, polygons = [], []
+    per_region = max(records // len(REGIONS), 1)
+
+    for state_code, (lon, lat) in REGIONS:
+        origin = transform(4269, 3857, Point(lon, lat))
+        mile = mile_wm(lat)
+        # API region / county around all the sites of the region
+        api_region = box(origin.x - 200 * mile, origin.y - 200 * mile, origin.x + 200 * mile, origin.y + 200 * mile)
+
+        # a few records share a site, like wells drilled in the same section
+        sites = {}
+        for n in range(per_region):
+            site = rnd.randint(0, max(per_region // 4, 1))
+            row, column = divmod(site, 36)
+            x, y = origin.x + (column % 6) * mile + (column // 6) * 6 * mile, origin.y + row * mile
+            rec = make_rec(state_code, len(recs) + 1, site, rnd)
+            model = define_type(rec)
+
+            if site not in sites:
+                if state_code == 'TX':
+                    sites[site] = texas_abstract(x, y, rnd, rnd.choice((200, 1000, 4000)))
+                elif state_code == 'ND' and site % 3 == 0:
+                    sites[site] = irregular_section(x, y, mile, rnd)
+                elif state_code == 'BC':
+                    sites[site] = square_section(x, y, mile / 4.0, 4)
+                else:
+                    sites[site] = square_section(x, y, mile)
+                polygons.append(sites[site])
+
+            with quiet():
+                lookups = model.reference_lookups()
+            for name, _lookup in lookups.iteritems():
+                if name == 'Api_region':
+                    backend.add(_lookup, api_region)
+                elif name == 'qqSection':
+                    minx, miny, maxx, maxy = sites[site].bounds
+                    backend.add(_lookup, box(minx, maxy - (maxy - miny) / 4.0, minx + (maxx - minx) / 4.0, maxy))
+                else:
+                    backend.add(_lookup, sites[site])
+            recs.append(rec)
+
+    return recs, backend, polygons
+
+
+def make_rec (state_code, n, site, rnd):
+    row, column = divmod(site, 36)
+    geo = Fixture(legal_desc='synthetic', abstract_number=None, twnshp=None, twnshp_dir=None, range_=None, range_dir=None,
+                  section=None, qsection=None, qqsection=None, map_sheet=None, unit=None, quarter_unit=None, block=None,
+                  meridian=None, legal_subdivision=None, offset_1=None, offset_dir_1=None, offset_2=None, offset_dir_2=None)
+    api, uwi, county = '00-000-00000', '', Fixture(county_name='SYNTHETIC', mcode1=5, mcode2=None, mcode3=None)
+
+    if state_code == 'TX':
+        api = '42-%03i-%05i' % (site % 250, n)
+        geo.abstract_number = str(site)
+        geo.offset_1, geo.offset_dir_1 = rnd.uniform(100, 2500), rnd.choice(('FNL', 'FSL'))
+        geo.offset_2, geo.offset_dir_2 = rnd.uniform(100, 2500), rnd.choice(('FEL', 'FWL'))
+    elif state_code == 'ND':
+        api = '33-053-%05i' % n
+        geo.twnshp, geo.twnshp_dir, geo.range_, geo.range_dir = str(150 + row), 'N', str(100 + column // 6), 'W'
+        geo.section = str(column % 36 + 1)
+        if rnd.random() < 0.3:
+            geo.qsection, geo.qqsection = 'NW', 'NW'
+        geo.offset_1, geo.offset_dir_1 = rnd.uniform(100, 5000), rnd.choice(('FNL', 'FSL'))
+        geo.offset_2, geo.offset_dir_2 = rnd.uniform(100, 5000), rnd.choice(('FEL', 'FWL'))
+    elif state_code == 'AB':
+        uwi = '100/%02i-%02i-%03i-%02iW5/00' % (site % 16 + 1, column % 36 + 1, 40 + row, 1 + column // 6)
+        geo.meridian, geo.twnshp, geo.range_, geo.section = '5', str(40 + row), str(1 + column // 6), str(column % 36 + 1)
+        geo.offset_1, geo.offset_dir_1 = rnd.uniform(50, 1500), rnd.choice(('FNL', 'FSL'))
+        geo.offset_2, geo.offset_dir_2 = rnd.uniform(50, 1500), rnd.choice(('FEL', 'FWL'))
+    elif state_code == 'BC':
+        uwi = '200/A-%03i-A/094-A-16/00' % (site % 100 + 1)
+        geo.map_sheet, geo.block, geo.unit, geo.quarter_unit = '094-A-16', 'A', str(site + 1), 'A'
+        geo.offset_1 = rnd.choice((-1, 1)) * rnd.uniform(10, 350)
+        geo.offset_2 = rnd.choice((-1, 1)) * rnd.uniform(10, 350)
+
+    return Rec(coo=Fixture(id=n, easting=None, northing=None, epsg_code=None, loc_quality=None),
+               geo=geo, cty=county,
+               wbd=Fixture(id=n, locnum=str(n), wellpoint_type_id=513),
+               wb=Fixture(api=api, uwi=uwi),
+               sta=Fixture(state_code=state_code),
+               prm=Fixture(posted_date=datetime.date(2010, 1, 1)))
+
+
+@contextmanager
+def quiet():
+    # the models report every record on stdout, the benchmark only keeps the formatting cost
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def timed (results, name, function, items):
+    """
+        runs function(item) for every item, stores the timing under name; returns the number of failed calls
+    """
+    errors = 0
+    start = time.time()
+    with quiet():
+        for item in items:
+            try:
+                function(item)
+            except Exception:
+                errors += 1
+    elapsed = time.time() - start
+    calls = len(items)
+    results[name] = {
+        'calls'         : calls,
+        'errors'        : errors,
+        'seconds'       : round(elapsed, 6),
+        'us_per_call'   : round(elapsed / calls * 1e6, 3) if calls else None,
+        'per_second'    : round(calls / elapsed, 1) if elapsed else None,
+    }
+    return errors
+
+
+def reset_caches():
+    lookup.configure_geometry_cache()
+    quality.configure_quality_engine()
+    memo.configure_result_memo()
+
+
+def run (records=2000, seed=0):
+    recs, backend, polygons = build_fixtures(records, seed)
+    lookup.set_backend(backend)
+    stages = {}
+
+    timed(stages, 'define_type', define_type, recs)
+
+    timed(stages, 'corner_detector', lambda polygon: CornerDetector(polygon).get_four_corners(), polygons)
+
+    # offsets of the PLS records against their section corners
+    with quiet():
+        models = [define_type(rec) for rec in recs]
+        pls = [model for model in models if model.__class__.__name__ == 'PLS']
+        offsets = []
+        for model in pls:
+            corners = model.geometry().four_corners(model.corner_shape)
+            if corners:
+                offsets.append((model.reference_lookups()[model.corner_shape].key(), (corners, model.offset_1, model.offset_dir_1, model.offset_2, model.offset_dir_2)))
+    timed(stages, 'calc_point_from_offsets', lambda args: calc_point_from_offsets(*args, units='feet'), [args for key, args in offsets])
+
+    # the same offsets in one batch per section
+    groups = {}
+    for key, args in offsets:
+        groups.setdefault(key, []).append(args)
+    batches = [(group[0][0], [a[1] for a in group], [a[2] for a in group], [a[3] for a in group], [a[4] for a in group]) for group in groups.values()]
+    timed(stages, 'calc_points_from_offsets_batch', lambda args: calc_points_from_offsets(*args, units='feet'), batches)
+    stages['calc_points_from_offsets_batch']['points'] = len(offsets)
+
+    points = [Point(polygon.centroid.x, polygon.centroid.y) for polygon in polygons]
+    timed(stages, 'transform', lambda point: transform(3857, 4269, point), points)
+
+    # location quality of records with a calculated point and their reference shapes assigned
+    with quiet():
+        located = []
+        for model in models:
+            try:
+                model.coordinates()
+                model.assign_ref_shapes()
+            except Exception:
+                continue
+            if model.get_point():
+                located.append(model)
+    quality.configure_quality_engine()
+    timed(stages, 'define_location_quality', lambda model: model.define_location_quality(), located)
+
+    # end to end from cold caches, the fixture fetches included
+    reset_caches()
+    fetches = backend.fetches
+    timed(stages, 'records', lambda rec: process_record(define_type(rec)), recs)
+    stages['records']['fixture_fetches'] = backend.fetches - fetches
+
+    lookup.set_backend(None)
+    return {
+        'timestamp' : datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'revision'  : revision(),
+        'python'    : platform.python_version(),
+        'platform'  : platform.platform(),
+        'seed'      : seed,
+        'records'   : len(recs),
+        'sections'  : len(polygons),
+        'vertices'  : sum(len(polygon.exterior.coords) for polygon in polygons),
+        'stages'    : stages,
+    }
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, 'w')).strip()
+    except Exception:
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='offline benchmark of the coordinate pipeline on generated fixtures')
+    parser.add_argument('--records', type=int, default=2000, help='number of synthetic records')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the fixture generator')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file the results are written to')
+    args = parser.parse_args()
+
+    results = run(args.records, args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    for name, stage in sorted(results['stages'].iteritems()):
+        print '%-32s %8i calls %10.1f us/call %10.1f /s %6i errors' % (name, stage['calls'], stage['us_per_call'] or 0, stage['per_second'] or 0, stage['errors'])
+    print 'results written to %s' % args.output
@@ -0,0 +1,126 @@
+"""
+    checkpoint of a run: the WellBoreDetail id ranges whose records are processed and written,
+    so an interrupted run resumes after them instead of reprocessing everything
+
+    the checkpoint is only advanced when the writer commits a transaction, everything it covers is written by then;
+    dry runs read the checkpoint but never advance it
+"""
+import os
+import json
+import time
+import bisect
+
+
+class CheckpointException(Exception): pass
+
+
+class Checkpoint():
+    """
+        path    : JSON file the checkpoint is kept in
+        filters : filters of the run (see router.build_query), a checkpoint only resumes a run with the same filters
+    """
+    def __init__(self, path, filters):
+        self.path = path
+        self.filters = filters
+        self.ranges = []        # sorted, disjoint [first id, last id] ranges of completed records
+        self.processed = 0
+        self.reported = 0
+        self.first_id = None    # WellBoreDetail id of the first record of a serial run
+        self.last_id = None     # WellBoreDetail id of the record being processed
+        self.completed = None   # last WellBoreDetail id all the records of are processed, not written yet
+
+    def load(self):
+        """
+            reads the checkpoint of an interrupted run, returns False if there is none
+        """
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                state = json.load(f)
+        elif os.path.exists(self.temp_path()):
+            # a save interrupted between removing the checkpoint and moving the new one over it (see save)
+            try:
+                with open(self.temp_path()) as f:
+                    state = json.load(f)
+            except ValueError:
+                # the first save was interrupted while writing, nothing was completed before it
+                return False
+        else:
+            return False
+        if state['filters'] != self.filters:
+            raise CheckpointException('checkpoint %s was written for other filters: %s' % (self.path, state['filters']))
+        self.ranges = [tuple(_range) for _range in state['ranges']]
+        self.processed = state['processed']
+        self.reported = state['reported']
+        return True
+
+    def save(self):
+        state = {
+            'filters'   : self.filters,
+            'ranges'    : self.ranges,
+            'processed' : self.processed,
+            'reported'  : self.reported,
+            'updated'   : time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        # written next to the checkpoint and moved over it: an interrupted write leaves the previous checkpoint intact;
+        # Windows cannot rename over an existing file, the checkpoint is removed first and load falls back
+        # to the new one if the save is interrupted in between
+        temp_path = self.temp_path()
+        with open(temp_path, 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(temp_path, self.path)
+
+    def temp_path(self):
+        return self.path + '.tmp'
+
+    def add_range(self, first_id, last_id):
+        ranges = self.ranges + [(first_id, last_id)]
+        ranges.sort()
+        # merge the adjacent and overlapping ranges
+        self.ranges = [ranges[0]]
+        for first, last in ranges[1:]:
+            if first <= self.ranges[-1][1] + 1:
+                self.ranges[-1] = (self.ranges[-1][0], max(last, self.ranges[-1][1]))
+            else:
+                self.ranges.append((first, last))
+
+    def done(self, key):
+        i = bisect.bisect_right(self.ranges, (key, float('inf')))
+        return i > 0 and self.ranges[i - 1][0] <= key <= self.ranges[i - 1][1]
+
+    def exclude(self, query, column):
+        """
+            filters the completed ranges out of the query
+        """
+        for first_id, last_id in self.ranges:
+            query = query.filter(~column.between(first_id, last_id))
+        return query
+
+    def advance(self, key, reported=False):
+        """
+            serial runs: the record of the WellBoreDetail id is processed; the records come ordered by the id,
+            several rows (permits) can share one id, so an id is completed when the next one starts
+        """
+        if self.first_id is None:
+            self.first_id = key
+        if key != self.last_id:
+            self.completed = self.last_id
+            self.last_id = key
+        self.processed += 1
+        if reported:
+            self.reported += 1
+
+    def commit(self):
+        """
+            the writer ended a transaction: everything processed so far is written, saves the completed records
+        """
+        if self.completed is not None:
+            self.add_range(self.first_id, self.completed)
+            self.save()
+
+    def finish(self):
+        # the run is completed, the last id included
+        if self.last_id is not None:
+            self.completed = self.last_id
+        self.commit()
@@ -0,0 +1,217 @@
+"""
+    persistent index of the four corners of the reference polygons, keyed by (table, lookup predicate)
+
+    build/update the index for all features of the corner layers:
+        python corners.py corners.sqlite                        # all corner layers
+        python corners.py corners.sqlite PLSS_SEC_5 DLS_AB_SEC  # only the given tables
+
+    during a run, missing corners are calculated on first use and added to the index (see set_corner_index)
+"""
+import os
+import json
+import sqlite3
+import argparse
+from shapely import wkb
+from shapely.geometry import Point
+
+from utils import CornerDetector
+from lookup import Lookup, queryHull, get_pool
+from mirror import LAYERS, SOURCE_DATABASE, list_layer_tables, local_table_name
+
+
+# layers whose polygons are used for the corners (coordinates() of the models)
+CORNER_LAYERS = ('TexasSurveys', 'PLSS[_]SEC[_]%', 'DLS[_]%[_]SEC', 'TS[_]%[_]UNITS')
+
+# optional Reduce tolerance (meters, web mercator) applied by the server before the convex hull
+HULL_TOLERANCE = None
+
+
+# version of the index keys (Lookup.key()) and of the stored corners, kept in the user_version of the SQLite file
+CORNER_INDEX_VERSION = 1
+
+
+class CornerIndexException(Exception): pass
+
+
+class CornerIndex():
+    """
+        four corners per reference polygon in a SQLite file, keyed by the exact Lookup.key(): the key values
+        of build_table are the table values, a model passing them in another form (e.g. TWN of the DLS layers as a string)
+        misses them and indexes the corners under its own key on first use;
+        the connection is opened per process, so the index can be shared by the parallel workers;
+        every put is committed right away by default, a worker holding the write lock would make the others fail
+
+        an index of another version (see CORNER_INDEX_VERSION) is refused, or emptied with rebuild
+    """
+    def __init__(self, path, commit_interval=1, rebuild=False):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.rebuild = rebuild
+        self.db = None
+        self.pid = None
+        self.pending = 0
+        self.hits = 0
+        self.misses = 0
+
+    def connect(self):
+        if self.db is None or self.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=60)
+            # readers do not block the writer and the other way round
+            db.execute('PRAGMA journal_mode=WAL')
+            version = db.execute('PRAGMA user_version').fetchone()[0]
+            if version != CORNER_INDEX_VERSION and db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'corners'").fetchone():
+                if not self.rebuild:
+                    db.close()
+                    raise CornerIndexException('corner index %s has version %i, version %i expected: rebuild it with python corners.py %s'
+                                               % (self.path, version, CORNER_INDEX_VERSION, self.path))
+                db.execute('DROP TABLE corners')
+            db.execute('CREATE TABLE IF NOT EXISTS corners (table_name TEXT, predicate TEXT, corners TEXT, PRIMARY KEY (table_name, predicate))')
+            db.execute('PRAGMA user_version = %i' % CORNER_INDEX_VERSION)
+            db.commit()
+            self.db = db
+            self.pid = os.getpid()
+            self.pending = 0
+        return self.db
+
+    def __contains__(self, lookup):
+        table, predicate = lookup.key()
+        return self.connect().execute('SELECT 1 FROM corners WHERE table_name = ? AND predicate = ?', (table, predicate)).fetchone() is not None
+
+    def get(self, lookup):
+        """
+            returns the indexed corners of the lookup's polygon (list of Points), None if it is not indexed
+        """
+        table, predicate = lookup.key()
+        row = self.connect().execute('SELECT corners FROM corners WHERE table_name = ? AND predicate = ?', (table, predicate)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [Point(x, y) for x, y in json.loads(row[0])]
+
+    def put(self, lookup, corners):
+        table, predicate = lookup.key()
+        self.connect().execute('INSERT OR REPLACE INTO corners VALUES (?, ?, ?)', (table, predicate, json.dumps([(pnt.x, pnt.y) for pnt in corners])))
+        self.pending += 1
+        if self.pending >= self.commit_interval:
+            self.commit()
+
+    def delete(self, lookup):
+        table, predicate = lookup.key()
+        self.connect().execute('DELETE FROM corners WHERE table_name = ? AND predicate = ?', (table, predicate))
+
+    def commit(self):
+        if self.db is not None and self.pid == os.getpid():
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        self.commit()
+        if self.db is not None and self.pid == os.getpid():
+            self.db.close()
+        self.db = None
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+_corner_index = None
+
+
+def set_corner_index(index):
+    global _corner_index
+    _corner_index = index
+
+
+def get_corner_index():
+    return _corner_index
+
+
+def queryCorners (lookup, tolerance=None, polygon=None):
+    """
+        returns the four corners of the polygon referenced by the lookup: from the corner index if possible,
+        otherwise calculated from the polygon's convex hull (and added to the index);
+        only the hull is fetched, the corner detection does not use the other vertices
+
+        polygon: the lookup's polygon if the caller has fetched it already
+
+        None if the polygon was not found, [] if no corners could be extracted
+    """
+    if _corner_index is not None:
+        corners = _corner_index.get(lookup)
+        if corners is not None:
+            return corners
+
+    if polygon is None:
+        polygon = queryHull(lookup, tolerance=tolerance if tolerance is not None else HULL_TOLERANCE)
+    if not polygon:
+        return None
+
+    corners = CornerDetector(polygon).get_four_corners() or []
+    if _corner_index is not None and corners:
+        _corner_index.put(lookup, corners)
+    return corners
+
+
+def build_table (index, cursor, table, columns, batch_size=1000):
+    """
+        calculates the corners of every feature of the table; features sharing a key are left out of the index,
+        the same way queryWKT rejects lookups returning more than one polygon
+    """
+    cursor.execute('SELECT %s, geom.STConvexHull().STAsBinary() FROM %s.dbo.[%s] WHERE geom IS NOT NULL' % (', '.join('[%s]' % column for column in columns), SOURCE_DATABASE, table))
+    seen, duplicates = set(), {}
+    indexed = 0
+    rows = cursor.fetchmany(batch_size)
+    while rows:
+        for row in rows:
+            values = [value.rstrip() if isinstance(value, basestring) else value for value in row[:-1]]
+            lookup = Lookup('%s.dbo.%s' % (SOURCE_DATABASE, table), zip(columns, values))
+            key = lookup.key()
+            if key in seen:
+                duplicates[key] = lookup
+                continue
+            seen.add(key)
+
+            corners = CornerDetector(wkb.loads(str(row[-1]))).get_four_corners()
+            if corners:
+                index.put(lookup, corners)
+                indexed += 1
+        rows = cursor.fetchmany(batch_size)
+
+    for lookup in duplicates.values():
+        index.delete(lookup)
+    index.commit()
+    return indexed - len(duplicates)
+
+
+def build_index (path, tables=None, cursor=None):
+    if cursor is None:
+        with get_pool().cursor() as cursor:
+            return build_index(path, tables, cursor)
+
+    # built by a single process, committed in batches; an index of another version is emptied and built again
+    index = CornerIndex(path, commit_interval=1000, rebuild=True)
+
+    layer_tables = []
+    for pattern, columns in LAYERS:
+        if pattern in CORNER_LAYERS:
+            layer_tables.extend(list_layer_tables(cursor, [(pattern, columns)]))
+    if tables:
+        wanted = set(local_table_name(table).upper() for table in tables)
+        layer_tables = [(table, columns) for table, columns in layer_tables if table.upper() in wanted]
+
+    for table, columns in layer_tables:
+        print '%s: corners of %i features indexed' % (table, build_table(index, cursor, table, columns))
+
+    index.close()
+    return [table for table, columns in layer_tables]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='builds/updates the persistent four-corner index of the reference polygons')
+    parser.add_argument('path', help='SQLite file of the corner index')
+    parser.add_argument('tables', nargs='*', help='tables to index, all corner layers by default')
+    args = parser.parse_args()
+
+    if not build_index(args.path, args.tables):
+        print 'no reference layers found to index.'
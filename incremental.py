@@ -0,0 +1,115 @@
+"""
+    incremental runs: a fingerprint of the inputs every stored point was calculated from
+    (region model, reference lookup keys, offsets and directions, with the calculation version and settings,
+    see LegalDescription.fingerprint) is kept per CoordinateID in a SQLite file;
+    records whose fingerprint is unchanged since the last run are skipped before any reference shape is looked up
+
+    the fingerprints are saved only when the writer commits the points (not in dry runs),
+    a record interrupted before its point is written is processed again by the next run
+"""
+import os
+import sqlite3
+
+import metrics
+
+
+class FingerprintStore():
+    """
+        fingerprint per CoordinateID in a SQLite file;
+        the connection is opened per process, so the store can be read by the parallel workers
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.pid = None
+
+    def connect(self):
+        if self.db is None or self.pid != os.getpid():
+            self.db = sqlite3.connect(self.path, timeout=60)
+            self.db.execute('CREATE TABLE IF NOT EXISTS fingerprints (coordinate_id INTEGER PRIMARY KEY, fingerprint TEXT, '
+                            'updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP)')
+            self.pid = os.getpid()
+        return self.db
+
+    def get(self, coordinate_id):
+        row = self.connect().execute('SELECT fingerprint FROM fingerprints WHERE coordinate_id = ?', (coordinate_id,)).fetchone()
+        return row[0] if row else None
+
+    def put_many(self, fingerprints):
+        # fingerprints: [(CoordinateID, fingerprint)]
+        db = self.connect()
+        db.executemany('INSERT OR REPLACE INTO fingerprints (coordinate_id, fingerprint) VALUES (?, ?)', fingerprints)
+        db.commit()
+
+    def close(self):
+        if self.db is not None and self.pid == os.getpid():
+            self.db.close()
+        self.db = None
+
+
+class Incremental():
+    """
+        selects the records whose inputs changed (or that were never calculated)
+        and collects the fingerprints of the processed records until the writer commits them
+    """
+    def __init__(self, store):
+        self.store = store
+        self.selected = {}      # CoordinateID -> fingerprint of the selected records not processed yet
+        self.pending = []       # [(CoordinateID, fingerprint)] of the processed records not saved yet
+
+    def select(self, items):
+        """
+            items: [(Rec, model object)], returns the items to process
+        """
+        selected = []
+        for rec, model_object in items:
+            fingerprint = fingerprint_of(model_object)
+            if fingerprint is not None:
+                if self.store.get(rec.coo.id) == fingerprint:
+                    metrics.count('unchanged_records', region=model_object.__class__.__name__)
+                    continue
+                self.selected[rec.coo.id] = fingerprint
+            selected.append((rec, model_object))
+        return selected
+
+    def done(self, rec, stored=True):
+        # the record is processed, the fingerprint of its stored point is saved with the next commit;
+        # a record without a point is calculated again by the next run
+        fingerprint = self.selected.pop(rec.coo.id, None)
+        if fingerprint is not None and stored:
+            self.pending.append((rec.coo.id, fingerprint))
+
+    def take(self):
+        # the fingerprints collected by a worker process, saved by the main process (see router.process_partition)
+        pending, self.pending = self.pending, []
+        return pending
+
+    def commit(self, fingerprints=()):
+        self.pending.extend(fingerprints)
+        if self.pending:
+            self.store.put_many(self.take())
+
+    def close(self):
+        self.store.close()
+
+
+def fingerprint_of(model_object):
+    # None if the legal description of the record cannot be read, the record is processed every time
+    if model_object is None:
+        return None
+    try:
+        return model_object.fingerprint()
+    except Exception:
+        return None
+
+
+_incremental = None
+
+
+def set_incremental(incremental):
+    global _incremental
+    _incremental = incremental
+
+
+def get_incremental():
+    return _incremental
@@ -0,0 +1,616 @@
+import re
+import pymssql
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from sqlalchemy.pool import QueuePool
+from shapely import wkb
+from shapely.wkt import loads
+from shapely.errors import WKBReadingError
+
+import metrics
+from metrics import timer
+
+GIS_HOST = 'RDSQLDEV\\RDSQLDEV'
+
+# the connection pool is created on the first lookup, so runs against a local mirror never need the server
+_pool = None
+_pool_options = {}
+_pool_lock = threading.Lock()
+
+# backend answering the reference shape lookups instead of the GIS SQL Server (e.g. mirror.Mirror)
+_backend = None
+
+# transfer format of the geometries from the GIS SQL Server: 'wkb' (STAsBinary) or 'wkt' (STAsText)
+GEOMETRY_FORMATS = ('wkb', 'wkt')
+_geometry_format = 'wkb'
+
+
+class LookupPool():
+    """
+        pool of the GIS connections used for the reference shape lookups, every caller checks out its own cursor
+
+        size    : maximum number of open connections, callers wait for a free one beyond that
+        timeout : seconds to wait for a free connection
+        recycle : seconds after which a connection is reopened on checkout, -1 keeps the connections
+    """
+    def __init__(self, size=8, timeout=30, recycle=3600, host=GIS_HOST):
+        self.size = size
+        self.pool = QueuePool(lambda: pymssql.connect(host=host), pool_size=size, max_overflow=0, timeout=timeout, recycle=recycle)
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.peak = 0
+        self.invalidated = 0
+
+    @contextmanager
+    def cursor(self):
+        connection = self.pool.connect()
+        with self.lock:
+            self.checkouts += 1
+            self.peak = max(self.peak, self.pool.checkedout())
+        try:
+            yield connection.cursor()
+        except (pymssql.OperationalError, pymssql.InterfaceError), e:
+            # a dropped connection is discarded, the pool opens a new one on a following checkout
+            if connection_lost(e):
+                connection.invalidate()
+                with self.lock:
+                    self.invalidated += 1
+            raise
+        finally:
+            connection.close()
+
+    def stats(self):
+        return {
+            'size'        : self.size,
+            'open'        : self.pool.checkedin() + self.pool.checkedout(),
+            'checked_out' : self.pool.checkedout(),
+            'peak'        : self.peak,
+            'checkouts'   : self.checkouts,
+            'invalidated' : self.invalidated,
+        }
+
+    def dispose(self):
+        self.pool.dispose()
+
+
+def configure_pool(size=8, timeout=30, recycle=3600, host=GIS_HOST):
+    """
+        sets the options of the lookup connection pool, it is (re)created on the next lookup
+    """
+    global _pool, _pool_options
+    if _pool is not None:
+        _pool.dispose()
+    _pool = None
+    _pool_options = {'size': size, 'timeout': timeout, 'recycle': recycle, 'host': host}
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = LookupPool(**_pool_options)
+    return _pool
+
+
+def pool_stats():
+    # None if no lookup went to the server
+    return _pool.stats() if _pool is not None else None
+
+
+# pools dropped by reset_pool, referenced so their connections are not closed by the garbage collector
+_dropped_pools = []
+
+
+def reset_pool():
+    # drops the pooled connections without closing them, e.g. in a forked worker process
+    global _pool
+    if _pool is not None:
+        _dropped_pools.append(_pool)
+    _pool = None
+
+
+# DB-Lib errors of a connection that is dropped or cannot be used anymore
+CONNECTION_ERRORS = (20002, 20003, 20004, 20006, 20009, 20017, 20047)
+CONNECTION_MESSAGES = ('DBPROCESS is dead', 'Connection is closed', 'connection timed out', 'Read from the server failed',
+                       'Write to the server failed', 'Unexpected EOF from the server', 'Unable to connect')
+
+
+def connection_lost (error):
+    """
+        True if the error means the connection is gone; other errors (syntax, permissions, conversions, deadlocks)
+        are raised as they are, retrying them on a new connection would only repeat them
+    """
+    if isinstance(error, pymssql.InterfaceError):
+        return True
+    if error.args and error.args[0] in CONNECTION_ERRORS:
+        return True
+    message = str(error).lower()
+    return any(part.lower() in message for part in CONNECTION_MESSAGES)
+
+
+def with_pooled_cursor (function, *args):
+    """
+        runs function(cursor, *args) on a cursor checked out from the pool;
+        repeated once on a new connection if the connection was dropped
+    """
+    try:
+        with get_pool().cursor() as cursor:
+            return function(cursor, *args)
+    except (pymssql.OperationalError, pymssql.InterfaceError), e:
+        if not connection_lost(e):
+            raise
+        metrics.outcome(metrics.LOOKUP_RETRY, '\tlookup failed (%s), retrying on a new connection' % e, record=False)
+        with get_pool().cursor() as cursor:
+            return function(cursor, *args)
+
+
+def set_backend(backend):
+    """
+        backend: object with fetch_geometry(table, where_clause) -> (geometry, size), None for the GIS SQL Server
+    """
+    global _backend
+    _backend = backend
+
+
+def get_backend():
+    return _backend
+
+
+class LookupException(Exception): pass
+
+
+def set_geometry_format(geometry_format):
+    global _geometry_format
+    if geometry_format not in GEOMETRY_FORMATS:
+        raise LookupException('Unknown geometry format: %s' % geometry_format)
+    _geometry_format = geometry_format
+
+
+def get_geometry_format():
+    return _geometry_format
+
+
+def queryWKT (table, where_clause, cursor=None, geometry='geom', lookup=None ):
+    return query_single(table, where_clause, '%s.STAsText()' % geometry, cursor, lookup)
+
+
+def queryWKB (table, where_clause, cursor=None, geometry='geom', lookup=None ):
+    blob = query_single(table, where_clause, '%s.STAsBinary()' % geometry, cursor, lookup)
+    return str(blob) if blob is not None else None
+
+
+def query_single (table, where_clause, expression, cursor=None, lookup=None ):
+    """
+        returns the expression for the single row matching the where clause, None if there is not exactly one row;
+        with a lookup the row is selected by the parameterized statement of its table (see LookupStatement)
+    """
+    if cursor is None:
+        return with_pooled_cursor(lambda cursor: query_single(table, where_clause, expression, cursor, lookup))
+
+    with timer('lookup_query'):
+        if lookup is not None:
+            statement = get_statement(cursor, lookup, expression)
+            executed = statement.execute(cursor, lookup.get_values())
+            select_statement = '%s [%s]' % (statement.sql, ', '.join(sql_literal(value) for value in lookup.get_values()))
+        else:
+            select_statement = 'SELECT  %s FROM %s WHERE %s' % (expression, table, where_clause)
+            # print select_statement
+            cursor.execute(select_statement)
+            executed = True
+        row = cursor.fetchone() if executed else None
+        row1 = cursor.fetchone() if row else None
+    # print row
+    while row:
+        # print row[0]
+        if row1:
+            metrics.outcome(metrics.MULTIPLE_POLYGONS, '\tmore than one polygon returned from the statement: %s' % select_statement, table=table, record=False)
+            return None
+        return row[0]
+    metrics.outcome(metrics.NO_RECORD, '\tno record returned based on statement: %s' % select_statement, table=table, record=False)
+    return None
+
+
+class GeometryCache():
+    """
+        LRU cache of parsed reference geometries keyed by (table, normalized predicate),
+        safe to share between the lookup threads
+
+        max_entries : maximum number of cached geometries
+        max_bytes   : optional bound on the summed size of the cached geometries (size of the fetched WKB/WKT)
+    """
+    def __init__(self, max_entries=10000, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()     # key -> (geometry, size), least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self._items
+
+    def get(self, key):
+        """
+            returns (found, geometry); the geometry is None for cached lookups that did not return a single polygon
+        """
+        with self.lock:
+            try:
+                item = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return False, None
+
+            # re-insert as the most recently used
+            self._items[key] = item
+            self.hits += 1
+            return True, item[0]
+
+    def put(self, key, geometry, size=0):
+        with self.lock:
+            if key in self._items:
+                self.size -= self._items.pop(key)[1]
+            self._items[key] = (geometry, size)
+            self.size += size
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            while self._items and (len(self._items) > self.max_entries or (self.max_bytes is not None and self.size > self.max_bytes)):
+                key, (geometry, size) = self._items.popitem(last=False)
+                self.size -= size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self._items.clear()
+            self.size = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries'   : len(self._items),
+            'bytes'     : self.size,
+            'hits'      : self.hits,
+            'misses'    : self.misses,
+            'evictions' : self.evictions,
+            'hit_ratio' : float(self.hits) / lookups if lookups else 0.0,
+        }
+
+
+_geometry_cache = GeometryCache()
+
+
+def get_geometry_cache():
+    return _geometry_cache
+
+
+def configure_geometry_cache(max_entries=10000, max_bytes=None):
+    global _geometry_cache
+    _geometry_cache = GeometryCache(max_entries, max_bytes)
+    return _geometry_cache
+
+
+_literal = re.compile(r"((?<!\w)N?'(?:[^']|'')*')")
+_like_literal = re.compile(r"\bLIKE (N?'[^'%_\[]*')")
+
+
+def normalize_predicate (where_clause):
+    """
+        normalizes the where clause so that equivalent predicates share one cache key:
+            - whitespace collapsed and keywords/column names upper-cased (string literals, N'...' included, are kept as they are)
+            - LIKE against a literal without wildcards is the same lookup as =
+    """
+    parts = _literal.split(where_clause)
+    # odd parts are the string literals
+    parts = [part if i % 2 else ' '.join(part.upper().split()) for i, part in enumerate(parts)]
+    clause = ' '.join(part for part in parts if part)
+    return _like_literal.sub(r'= \1', clause)
+
+
+def cache_key (table, where_clause):
+    return table.strip().upper(), normalize_predicate(where_clause)
+
+
+def queryGeometry (table, where_clause, cursor=None, cache=None, lookup=None):
+    """
+        returns the parsed (shapely) geometry for the where clause, None if there is not exactly one polygon;
+        parsed geometries are kept in the LRU cache so repeated lookups skip the database and WKT parsing
+    """
+    cache = cache if cache is not None else _geometry_cache
+    key = cache_key(table, where_clause)
+
+    found, geometry = cache.get(key)
+    if found:
+        return geometry
+
+    if _backend is not None and cursor is None:
+        with timer('backend_query'):
+            geometry, size = _backend.fetch_geometry(table, where_clause)
+    else:
+        geometry, size = fetch_geometry(table, where_clause, cursor, lookup=lookup)
+    cache.put(key, geometry, size)
+    return geometry
+
+
+def fetch_geometry (table, where_clause, cursor=None, geometry='geom', lookup=None):
+    """
+        fetches and parses the geometry in the configured transfer format, returns (geometry, size in bytes);
+        geometries that cannot be read from WKB are fetched again as WKT
+
+        geometry: geometry expression evaluated by the server, e.g. 'geom.STConvexHull()'
+    """
+    if _geometry_format == 'wkb':
+        blob = queryWKB(table, where_clause, cursor, geometry, lookup)
+        if blob is None:
+            return None, 0
+        with timer('parse_wkb'):
+            geometry = parse_wkb(blob)
+        if geometry is not None:
+            return geometry, len(blob)
+        metrics.outcome(metrics.INVALID_WKB, '\tgeometry could not be read from WKB, falling back to WKT: %s: %s' % (table, where_clause), table=table, record=False)
+
+    wkt = queryWKT(table, where_clause, cursor, geometry, lookup)
+    if not wkt:
+        return None, 0
+    with timer('parse_wkt'):
+        return loads(wkt), len(wkt)
+
+
+def parse_wkb (blob):
+    try:
+        return wkb.loads(blob)
+    except WKBReadingError:
+        return None
+
+
+class Lookup(object):
+    """
+        reference shape lookup: table plus the (column, value) pairs it is matched on with equality
+
+    """
+    def __init__(self, table, columns):
+        self.table = table
+        self.columns = tuple(columns)
+
+    def get_column_names(self):
+        return tuple(column for column, value in self.columns)
+
+    def get_values(self):
+        return tuple(value for column, value in self.columns)
+
+    def where_clause(self):
+        return ' AND '.join('%s = %s' % (column, sql_literal(value)) for column, value in self.columns)
+
+    def key(self):
+        return cache_key(self.table, self.where_clause())
+
+    def __str__(self):
+        return '%s: %s' % (self.table, self.where_clause())
+
+
+class LookupStatement():
+    """
+        parameterized lookup statement of one reference table: equality on the key columns, parameters declared
+        with the column types so SQL Server can seek on the indexes; executed through sp_executesql, the plan
+        is compiled once and reused for every key
+
+        string parameters are declared without their column length (see column_types),
+        a longer key is compared in full and matches nothing instead of being truncated to a match
+    """
+    def __init__(self, table, columns, types, expression):
+        self.sql = u'SELECT %s FROM %s WHERE %s' % (expression, table, ' AND '.join('[%s] = @p%i' % (column, i) for i, column in enumerate(columns)))
+        self.declaration = u', '.join('@p%i %s' % (i, _type) for i, _type in enumerate(types))
+        self.integers = [_type in INTEGER_TYPES for _type in types]
+        self.statement = 'EXEC sp_executesql %%s, %%s, %s' % ', '.join('@p%i = %%s' % i for i in range(len(columns)))
+
+    def execute(self, cursor, values):
+        """
+            returns False without querying if a key is not a number where the column is an integer, it matches no row
+        """
+        values = typed_values(values, self.integers)
+        if values is None:
+            return False
+        cursor.execute(self.statement, (self.sql, self.declaration) + values)
+        return True
+
+
+INTEGER_TYPES = ('INT', 'BIGINT', 'SMALLINT', 'TINYINT', 'BIT')
+
+# prepared statements by (table, key columns, selected expression)
+_statements = {}
+
+# SQL types of the key columns by (table, key columns)
+_column_types = {}
+
+
+def get_statement (cursor, lookup, expression):
+    key = (lookup.table.upper(), lookup.get_column_names(), expression)
+    statement = _statements.get(key)
+    if statement is None:
+        statement = _statements[key] = LookupStatement(lookup.table, lookup.get_column_names(), get_column_types(cursor, lookup), expression)
+    return statement
+
+
+def get_column_types (cursor, lookup):
+    key = (lookup.table.upper(), lookup.get_column_names())
+    types = _column_types.get(key)
+    if types is None:
+        types = _column_types[key] = column_types(cursor, lookup.table, lookup.get_column_names(), lookup.get_values())
+    return types
+
+
+def typed_values (values, integers):
+    """
+        the lookup values as the key columns take them, None if a value is not a number where the column is an integer
+    """
+    try:
+        return tuple(int(value) if integer else unicode(value) for value, integer in zip(values, integers))
+    except ValueError:
+        return None
+
+
+def column_types (cursor, table, columns, values):
+    """
+        returns the SQL types of the key columns, guessed from the lookup values for the columns not found;
+        string columns are typed (N)VARCHAR(MAX): a parameter of the column length would silently truncate longer keys
+        table: [[database.]schema.]table, without a schema the default schema of the user
+    """
+    parts = [part.strip('[]') for part in table.split('.')]
+    columns_view = '%s.INFORMATION_SCHEMA.COLUMNS' % parts[0] if len(parts) == 3 else 'INFORMATION_SCHEMA.COLUMNS'
+    if len(parts) > 1:
+        cursor.execute('SELECT COLUMN_NAME, DATA_TYPE, NUMERIC_PRECISION, NUMERIC_SCALE FROM %s WHERE TABLE_SCHEMA = %%s AND TABLE_NAME = %%s' % columns_view, (parts[-2], parts[-1]))
+    else:
+        cursor.execute('SELECT COLUMN_NAME, DATA_TYPE, NUMERIC_PRECISION, NUMERIC_SCALE FROM %s WHERE TABLE_SCHEMA = SCHEMA_NAME() AND TABLE_NAME = %%s' % columns_view, (parts[-1],))
+    described = dict((row[0].upper(), row[1:]) for row in cursor.fetchall())
+
+    types = []
+    for column, value in zip(columns, values):
+        if column.upper() not in described:
+            types.append('INT' if isinstance(value, (int, long)) else 'NVARCHAR(MAX)')
+            continue
+        data_type, precision, scale = described[column.upper()]
+        data_type = data_type.upper()
+        if data_type in ('CHAR', 'VARCHAR'):
+            types.append('VARCHAR(MAX)')
+        elif data_type in ('NCHAR', 'NVARCHAR'):
+            types.append('NVARCHAR(MAX)')
+        elif data_type in ('DECIMAL', 'NUMERIC'):
+            types.append('%s(%s, %s)' % (data_type, precision, scale))
+        else:
+            types.append(data_type)
+    return types
+
+
+def sql_literal (value):
+    if isinstance(value, (int, long)):
+        return '%i' % value
+    return u"N'%s'" % unicode(value).replace("'", "''")
+
+
+def queryShape (lookup, cursor=None, cache=None):
+    return queryGeometry(lookup.table, lookup.where_clause(), cursor, cache, lookup)
+
+
+def queryHull (lookup, cursor=None, cache=None, tolerance=None):
+    """
+        returns the convex hull of the lookup's polygon, None if there is not exactly one polygon;
+        the hull is computed by the server (STConvexHull, after Reduce(tolerance) if given) so only its vertices
+        are transferred, unless the full geometry is cached already
+    """
+    cache = cache if cache is not None else _geometry_cache
+    if lookup.key() in cache or (_backend is not None and cursor is None):
+        geometry = queryShape(lookup, cursor, cache)
+        return geometry.convex_hull if geometry else None
+
+    key = hull_key(lookup, tolerance)
+    found, hull = cache.get(key)
+    if found:
+        return hull
+
+    hull, size = fetch_geometry(lookup.table, lookup.where_clause(), cursor, hull_expression(tolerance), lookup)
+    cache.put(key, hull, size)
+    return hull
+
+
+def hull_key (lookup, tolerance=None):
+    # hulls are cached next to the full geometries, under their own key
+    return lookup.key() + ('HULL', tolerance or None)
+
+
+def hull_expression (tolerance=None):
+    return 'geom.Reduce(%r).STConvexHull()' % float(tolerance) if tolerance else 'geom.STConvexHull()'
+
+
+def prefetch (lookups, cursor=None, cache=None, batch_size=1000, hulls=False, tolerance=None):
+    """
+        fetches the geometries of many lookups with one set-based query per table (and key columns)
+        and stores them into the geometry cache, so the following queryShape/queryGeometry calls are cache hits;
+        with hulls only the convex hulls are fetched (for queryHull), except for the lookups cached in full
+
+        returns the number of fetched lookups
+    """
+    cache = cache if cache is not None else _geometry_cache
+    if cursor is None:
+        if _backend is not None:
+            # lookups against a local backend are cheap enough one by one
+            return 0
+        return with_pooled_cursor(lambda cursor: prefetch(lookups, cursor, cache, batch_size, hulls, tolerance))
+
+    groups = {}
+    seen = set()
+    for lookup in lookups:
+        key = hull_key(lookup, tolerance) if hulls else lookup.key()
+        if key in seen or key in cache or lookup.key() in cache:
+            continue
+        seen.add(key)
+        groups.setdefault((key[0], lookup.get_column_names()), []).append(lookup)
+
+    for (table, columns), group in groups.iteritems():
+        if hulls:
+            prefetch_table(group[0].table, columns, group, cursor, cache, batch_size, hull_expression(tolerance), [hull_key(lookup, tolerance) for lookup in group])
+        else:
+            prefetch_table(group[0].table, columns, group, cursor, cache, batch_size)
+
+    return len(seen)
+
+
+def prefetch_table (table, columns, lookups, cursor, cache, batch_size=1000, geometry='geom', keys=None):
+    """
+        loads the lookup keys into a temp table and joins it against the reference table;
+        the geometries are cached under keys (default: the keys of the lookups)
+    """
+    keys = keys if keys is not None else [lookup.key() for lookup in lookups]
+    # the keys are declared with the types of the reference columns (see column_types),
+    # the string columns in the collation of the database rather than the one of tempdb
+    types = get_column_types(cursor, lookups[0])
+    integers = [_type in INTEGER_TYPES for _type in types]
+    values = [typed_values(lookup.get_values(), integers) for lookup in lookups]
+    cursor.execute("IF OBJECT_ID('tempdb..#lookup_keys') IS NOT NULL DROP TABLE #lookup_keys")
+    cursor.execute('CREATE TABLE #lookup_keys (%s)' % ', '.join('[%s] %s' % (column, _type if integer else _type + ' COLLATE DATABASE_DEFAULT')
+                                                               for column, _type, integer in zip(columns, types, integers)))
+
+    # SQL Server accepts up to 1000 rows in one VALUES list; keys that are not numbers for integer columns match nothing
+    rows = ['(%s)' % ', '.join(sql_literal(value) for value in _values) for _values in values if _values is not None]
+    batch_size = min(batch_size, 1000)
+    for i in range(0, len(rows), batch_size):
+        cursor.execute('INSERT INTO #lookup_keys VALUES %s' % ', '.join(rows[i:i + batch_size]))
+
+    select_statement = 'SELECT %s, t.%s.%s() FROM %s t JOIN #lookup_keys k ON %s' % (
+        ', '.join('k.[%s]' % column for column in columns),
+        geometry,
+        'STAsBinary' if _geometry_format == 'wkb' else 'STAsText',
+        table,
+        ' AND '.join('t.[%s] = k.[%s]' % (column, column) for column in columns))
+    cursor.execute(select_statement)
+
+    # group the returned polygons by the key values
+    polygons = {}
+    for row in cursor.fetchall():
+        polygons.setdefault(tuple(_key_value(value) for value in row[:-1]), []).append(row[-1])
+    cursor.execute('DROP TABLE #lookup_keys')
+
+    for _values, key in zip(values, keys):
+        shapes = polygons.get(tuple(_key_value(value) for value in _values), []) if _values is not None else []
+        # same outcome as queryWKT: exactly one polygon or nothing
+        if len(shapes) != 1 or shapes[0] is None:
+            cache.put(key, None, 0)
+        elif _geometry_format == 'wkb':
+            blob = str(shapes[0])
+            shape = parse_wkb(blob)
+            # unreadable WKB is left out of the cache, queryGeometry falls back to WKT for it
+            if shape is not None:
+                cache.put(key, shape, len(blob))
+        else:
+            cache.put(key, loads(shapes[0]), len(shapes[0]))
+
+
+def _key_value (value):
+    return value if isinstance(value, (int, long)) else unicode(value)
@@ -0,0 +1,46 @@
+from lookup import GeometryCache
+
+
+class ResultMemo():
+    """
+        results of the records keyed by their normalized legal description (see LegalDescription.legal_description_key):
+        the wells of a pad site share the state, county, section / abstract, offsets and directions,
+        the first of them is calculated, the others reuse its point, location quality and outcome codes
+    """
+    def __init__(self, max_entries=100000):
+        self.results = GeometryCache(max_entries)
+
+    def key_of(self, model_object):
+        # None if the legal description of the record cannot be read, the record is not memoized
+        try:
+            return model_object.legal_description_key()
+        except Exception:
+            return None
+
+    def get(self, key):
+        """
+            returns (found, result)
+        """
+        if key is None:
+            return False, None
+        return self.results.get(key)
+
+    def put(self, key, result):
+        if key is not None:
+            self.results.put(key, result)
+
+    def stats(self):
+        return self.results.stats()
+
+
+_result_memo = ResultMemo()
+
+
+def get_result_memo():
+    return _result_memo
+
+
+def configure_result_memo(max_entries=100000):
+    global _result_memo
+    _result_memo = ResultMemo(max_entries) if max_entries else None
+    return _result_memo
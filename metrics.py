@@ -0,0 +1,365 @@
+"""
+    run instrumentation: per-stage timings (calls, cumulative time, p50/p95/p99 latency), labelled counters
+    and an optional progress line; dumped at the end of a run as JSON and in the Prometheus text format
+
+        with metrics.timer('lookup'):
+            ...
+        metrics.count('records', region='Texas')
+"""
+import time
+import json
+import random
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+
+# latencies kept per stage for the percentiles (uniform reservoir sample)
+RESERVOIR_SIZE = 2048
+
+PREFIX = 'coordinates'
+
+# outcome codes of the records, counted per region and table instead of printed for every record
+NO_MODEL                    = 'no_model'
+UNSUPPORTED_REGION          = 'unsupported_region'
+MISSING_LEGAL_DESCRIPTION   = 'missing_legal_description'
+INVALID_OFFSETS             = 'invalid_offsets'
+INVALID_LEGAL_DESCRIPTION   = 'invalid_legal_description'
+INVALID_API                 = 'invalid_api'
+UNHANDLED_MERIDIAN          = 'unhandled_meridian_zone'
+POLYGON_NOT_FOUND           = 'polygon_not_found'
+MULTIPLE_POLYGONS           = 'multiple_polygons'
+NO_RECORD                   = 'no_record'
+INVALID_WKB                 = 'invalid_wkb'
+LOOKUP_RETRY                = 'lookup_retry'
+NO_FOUR_CORNERS             = 'no_four_corners'
+UNKNOWN_DIRECTION           = 'unknown_direction'
+UNRESOLVED_OFFSET_LINES     = 'unresolved_offset_lines'
+EXTENDED_INTERSECTION       = 'extended_intersection'
+UNRESOLVED_INTERSECTION     = 'unresolved_intersection'
+INVALID_GEOMETRY            = 'invalid_geometry'
+NOT_CALCULATED              = 'not_calculated'
+
+# detail lines printed per outcome code before the outcome is only counted, None prints all of them (debug)
+DETAIL_LIMIT = 10
+# fraction of the outcomes past DETAIL_LIMIT whose detail line is still printed
+DETAIL_SAMPLE = 0.0
+
+
+class Stage():
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.samples = []
+
+    def observe(self, seconds):
+        self.calls += 1
+        self.seconds += seconds
+        if len(self.samples) < RESERVOIR_SIZE:
+            self.samples.append(seconds)
+        else:
+            i = random.randint(0, self.calls - 1)
+            if i < RESERVOIR_SIZE:
+                self.samples[i] = seconds
+
+    def merge(self, calls, seconds, samples):
+        # the samples of each side stand for its calls, each side keeps a share of the reservoir in proportion to them
+        if len(self.samples) + len(samples) > RESERVOIR_SIZE:
+            k = int(round(RESERVOIR_SIZE * float(self.calls) / (self.calls + calls)))
+            k = max(RESERVOIR_SIZE - len(samples), min(k, len(self.samples)))
+            self.samples = random.sample(self.samples, k) + random.sample(samples, RESERVOIR_SIZE - k)
+        else:
+            self.samples.extend(samples)
+        self.calls += calls
+        self.seconds += seconds
+
+    def percentile(self, q):
+        if not self.samples:
+            return None
+        samples = sorted(self.samples)
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+    def summary(self):
+        return {
+            'calls'   : self.calls,
+            'seconds' : self.seconds,
+            'p50'     : self.percentile(0.50),
+            'p95'     : self.percentile(0.95),
+            'p99'     : self.percentile(0.99),
+        }
+
+
+class Metrics():
+    """
+        stage timings and counters of a run, shared by the lookup threads
+    """
+    def __init__(self):
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}      # (name, ((label, value), ...)) -> count
+        self.details = {}       # outcome code -> detail lines seen
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = Stage()
+            self.stages[stage].observe(seconds)
+
+    def count(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def total(self, name):
+        # count of the counter over all its labels
+        with self.lock:
+            return sum(n for (counter, labels), n in self.counters.iteritems() if counter == name)
+
+    def show_detail(self, code):
+        """
+            True if the detail line of the outcome is to be printed: the first DETAIL_LIMIT ones per code,
+            a DETAIL_SAMPLE fraction of the rest
+        """
+        with self.lock:
+            seen = self.details[code] = self.details.get(code, 0) + 1
+        if DETAIL_LIMIT is None or seen <= DETAIL_LIMIT:
+            return True
+        return DETAIL_SAMPLE > 0 and random.random() < DETAIL_SAMPLE
+
+    def state(self):
+        """
+            picklable snapshot, e.g. to return the metrics of a worker process (see merge)
+        """
+        with self.lock:
+            return {
+                'stages'   : dict((name, (stage.calls, stage.seconds, list(stage.samples))) for name, stage in self.stages.iteritems()),
+                'counters' : dict(self.counters),
+            }
+
+    def merge(self, state):
+        with self.lock:
+            for name, (calls, seconds, samples) in state['stages'].iteritems():
+                self.stages.setdefault(name, Stage()).merge(calls, seconds, samples)
+            for key, n in state['counters'].iteritems():
+                self.counters[key] = self.counters.get(key, 0) + n
+
+    def summary(self):
+        with self.lock:
+            counters = {}
+            for (name, labels), n in sorted(self.counters.iteritems()):
+                counters.setdefault(name, []).append(dict(labels, count=n))
+            return {
+                'elapsed'  : time.time() - self.started,
+                'stages'   : dict((name, stage.summary()) for name, stage in self.stages.iteritems()),
+                'counters' : counters,
+            }
+
+    def prometheus(self):
+        """
+            returns the metrics in the Prometheus text exposition format
+        """
+        summary = self.summary()
+        lines = [
+            '# HELP %s_stage_seconds latency of the pipeline stages' % PREFIX,
+            '# TYPE %s_stage_seconds summary' % PREFIX,
+        ]
+        for name, stage in sorted(summary['stages'].iteritems()):
+            for q in ('0.5', '0.95', '0.99'):
+                value = stage['p%i' % int(float(q) * 100)]
+                if value is not None:
+                    lines.append('%s_stage_seconds{stage="%s",quantile="%s"} %r' % (PREFIX, name, q, value))
+            lines.append('%s_stage_seconds_sum{stage="%s"} %r' % (PREFIX, name, stage['seconds']))
+            lines.append('%s_stage_seconds_count{stage="%s"} %i' % (PREFIX, name, stage['calls']))
+
+        for name, series in sorted(summary['counters'].iteritems()):
+            lines.append('# TYPE %s_%s_total counter' % (PREFIX, name))
+            for labels in series:
+                n = labels.pop('count')
+                label_text = ','.join('%s="%s"' % (label, str(value).replace('"', '\\"')) for label, value in sorted(labels.iteritems()))
+                lines.append('%s_%s_total%s %i' % (PREFIX, name, '{%s}' % label_text if label_text else '', n))
+
+        lines.append('# TYPE %s_elapsed_seconds gauge' % PREFIX)
+        lines.append('%s_elapsed_seconds %r' % (PREFIX, summary['elapsed']))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, json_path=None, prometheus_path=None):
+        if json_path:
+            with open(json_path, 'w') as f:
+                json.dump(self.summary(), f, indent=2, sort_keys=True)
+        if prometheus_path:
+            with open(prometheus_path, 'w') as f:
+                f.write(self.prometheus())
+
+    def report(self):
+        summary = self.summary()
+        print 'stage timings:'
+        for name, stage in sorted(summary['stages'].iteritems(), key=lambda item: -item[1]['seconds']):
+            print '\t%-28s %8i calls %10.3fs  p50 %8.2fms  p95 %8.2fms  p99 %8.2fms' % (
+                name, stage['calls'], stage['seconds'], stage['p50'] * 1000, stage['p95'] * 1000, stage['p99'] * 1000)
+        outcomes = summary['counters'].get('outcomes')
+        if outcomes:
+            print 'outcomes:'
+            for labels in sorted(outcomes, key=lambda labels: -labels['count']):
+                print '\t%-28s %8i  %s' % (labels['code'], labels['count'],
+                    ', '.join('%s: %s' % (label, value) for label, value in sorted(labels.iteritems()) if label not in ('code', 'count')))
+
+
+class Progress():
+    """
+        prints the processed records, records/sec and the ETA at most every `interval` seconds
+    """
+    def __init__(self, total=None, interval=30):
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.started = self.printed = time.time()
+
+    def tick(self, n=1):
+        self.done += n
+        now = time.time()
+        if now - self.printed >= self.interval:
+            self.printed = now
+            print self.line(now)
+
+    def line(self, now=None):
+        elapsed = (now or time.time()) - self.started
+        rate = self.done / elapsed if elapsed else 0.0
+        line = '%i records processed, %.1f records/s' % (self.done, rate)
+        if self.total:
+            remaining = (self.total - self.done) / rate if rate else None
+            line += ', %.1f%%, ETA %s' % (100.0 * self.done / self.total, '%i:%02i:%02i' % (remaining // 3600, remaining % 3600 // 60, remaining % 60) if remaining is not None else '?')
+        return line
+
+
+_metrics = Metrics()
+_progress = None
+_context = threading.local()
+
+
+def get_metrics():
+    return _metrics
+
+
+def reset_metrics():
+    global _metrics
+    _metrics = Metrics()
+    return _metrics
+
+
+def set_enabled(enabled):
+    _metrics.enabled = enabled
+
+
+@contextmanager
+def timer(stage):
+    if not _metrics.enabled:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        _metrics.observe(stage, time.time() - start)
+
+
+def timed(stage):
+    """
+        decorator timing every call of the function as the stage
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _metrics.enabled:
+                return function(*args, **kwargs)
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _metrics.observe(stage, time.time() - start)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1, **labels):
+    if _metrics.enabled:
+        _metrics.count(name, n, **labels)
+
+
+def outcome(code, detail=None, record=True, **labels):
+    """
+        counts the outcome code with the labels of the record being processed by this thread (see set_context)
+        and the given labels, e.g. the table; the detail line is printed for a limited / sampled subset only
+
+        record : False for the outcomes of a (cached) query rather than of the record, they are not captured
+    """
+    labels = dict(getattr(_context, 'labels', {}), code=code, **labels)
+    _metrics.count('outcomes', **labels)
+    captured = getattr(_context, 'captured', None)
+    if record and captured is not None:
+        captured.append(labels)
+    if detail is not None and _metrics.show_detail(code):
+        print detail
+
+
+@contextmanager
+def capture_outcomes():
+    """
+        collects the record outcomes counted by this thread in the block, so they can be counted again
+        for the records reusing a memoized result (see replay_outcomes)
+    """
+    previous = getattr(_context, 'captured', None)
+    _context.captured = captured = []
+    try:
+        yield captured
+    finally:
+        _context.captured = previous
+
+
+def replay_outcomes(outcomes):
+    for labels in outcomes:
+        _metrics.count('outcomes', **labels)
+
+
+def set_context(**labels):
+    _context.labels = labels
+
+
+def clear_context():
+    _context.labels = {}
+
+
+def set_detail(limit=10, sample=0.0):
+    global DETAIL_LIMIT, DETAIL_SAMPLE
+    DETAIL_LIMIT = limit
+    DETAIL_SAMPLE = sample
+
+
+def show_detail(code):
+    return _metrics.show_detail(code)
+
+
+def start_progress(total=None, interval=30):
+    global _progress
+    _progress = Progress(total, interval)
+    return _progress
+
+
+def tick(n=1):
+    if _progress is not None:
+        _progress.tick(n)
+
+
+def timed_iter(stage, iterable):
+    """
+        yields the items of the iterable, timing how long every item takes to produce (e.g. a streamed query)
+    """
+    iterator = iter(iterable)
+    while True:
+        with timer(stage):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
@@ -0,0 +1,227 @@
+"""
+    local single-file (SQLite) mirror of the GISCoreData reference layers
+
+    export/sync:
+        python mirror.py GISCoreData.sqlite                     # all reference layers
+        python mirror.py GISCoreData.sqlite PLSS_SEC_5 DLS_AB_SEC  # only the given tables
+
+    the Mirror class answers the same lookups as lookup.queryWKT, see lookup.set_backend
+"""
+import os
+import re
+import sys
+import time
+import sqlite3
+import argparse
+from shapely import wkb
+
+from lookup import get_pool
+
+
+# reference layers: (table name pattern in GISCoreData, lookup columns)
+LAYERS = [
+    ('TexasSurveys',    ('COUNTY', 'ANUM1')),
+    ('PLSS[_]SEC[_]%',  ('StateCode', 'TWN', 'TWNDIR', 'RNG', 'RNGDIR', 'SECTION')),
+    ('PLSS[_]QQ[_]%',   ('TWN', 'TWNDIR', 'RNG', 'RNGDIR', 'SECTION', 'QQSECTION')),
+    ('DLS[_]%[_]SEC',   ('MER', 'TWN', 'RNG', 'SEC')),
+    ('TS[_]%[_]UNITS',  ('MAPSHEET', 'BLOCK', 'UNIT')),
+    ('API_Regions_WM',  ('FIPS_API',)),
+]
+
+SOURCE_DATABASE = 'GISCoreData'
+
+INTEGER_TYPES = ('int', 'bigint', 'smallint', 'tinyint', 'bit')
+
+
+class MirrorException(Exception): pass
+
+
+# unicode string literal of SQL Server (see lookup.sql_literal), a plain string literal in SQLite
+_national_literal = re.compile(r"(?<!\w)N('(?:[^']|'')*')")
+
+
+def sqlite_predicate (where_clause):
+    return _national_literal.sub(r'\1', where_clause)
+
+
+def local_table_name (table):
+    # 'GISCoreData.dbo.PLSS_SEC_5' -> 'PLSS_SEC_5'
+    return table.split('.')[-1].strip('[]')
+
+
+def list_layer_tables (cursor, layers=LAYERS):
+    """
+        returns [(table, lookup columns), ...] of the reference layers present in the source database
+    """
+    tables = []
+    for pattern, columns in layers:
+        cursor.execute("SELECT TABLE_NAME FROM %s.INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME LIKE '%s' ORDER BY TABLE_NAME" % (SOURCE_DATABASE, pattern))
+        tables.extend((row[0], columns) for row in cursor.fetchall())
+    return tables
+
+
+def column_types (cursor, table, columns):
+    cursor.execute("SELECT COLUMN_NAME, DATA_TYPE FROM %s.INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA = 'dbo' AND TABLE_NAME = '%s'" % (SOURCE_DATABASE, table))
+    types = dict((name.upper(), data_type.lower()) for name, data_type in cursor.fetchall())
+    missing = [column for column in columns if column.upper() not in types]
+    if missing:
+        raise MirrorException('table %s does not have the lookup columns: %s' % (table, ', '.join(missing)))
+
+    # text columns compare case-insensitively like the source collation, values are stored right-trimmed
+    return ['INTEGER' if types[column.upper()] in INTEGER_TYPES else 'TEXT COLLATE NOCASE' for column in columns]
+
+
+def create_metadata (db):
+    db.execute('CREATE TABLE IF NOT EXISTS layers (table_name TEXT PRIMARY KEY, lookup_columns TEXT, rows INTEGER, rtree INTEGER, synced_at TEXT)')
+
+
+def export_table (cursor, db, table, columns, batch_size=1000):
+    """
+        snapshots one reference table into the mirror: lookup columns + WKB geometry,
+        an index on the lookup columns and an R-tree on the geometry bounding boxes
+    """
+    types = column_types(cursor, table, columns)
+
+    db.execute('DROP TABLE IF EXISTS [%s]' % table)
+    db.execute('DROP TABLE IF EXISTS [%s_rtree]' % table)
+    db.execute('CREATE TABLE [%s] (fid INTEGER PRIMARY KEY, %s, geom BLOB)' % (table, ', '.join('[%s] %s' % (column, _type) for column, _type in zip(columns, types))))
+
+    try:
+        db.execute('CREATE VIRTUAL TABLE [%s_rtree] USING rtree(id, minx, maxx, miny, maxy)' % table)
+        rtree = True
+    except sqlite3.OperationalError:
+        print '\tR-tree module not available in this SQLite build, %s is exported without the spatial index' % table
+        rtree = False
+
+    insert_row = 'INSERT INTO [%s] VALUES (?, %s, ?)' % (table, ', '.join('?' for column in columns))
+    insert_box = 'INSERT INTO [%s_rtree] VALUES (?, ?, ?, ?, ?)' % table
+
+    cursor.execute('SELECT %s, geom.STAsBinary() FROM %s.dbo.[%s] WHERE geom IS NOT NULL' % (', '.join('[%s]' % column for column in columns), SOURCE_DATABASE, table))
+    fid = 0
+    rows = cursor.fetchmany(batch_size)
+    while rows:
+        _rows, _boxes = [], []
+        for row in rows:
+            fid += 1
+            blob = str(row[-1])
+            _rows.append([fid] + [value.rstrip() if isinstance(value, basestring) else value for value in row[:-1]] + [sqlite3.Binary(blob)])
+            if rtree:
+                minx, miny, maxx, maxy = wkb.loads(blob).bounds
+                _boxes.append((fid, minx, maxx, miny, maxy))
+        db.executemany(insert_row, _rows)
+        if rtree:
+            db.executemany(insert_box, _boxes)
+        rows = cursor.fetchmany(batch_size)
+
+    # attribute index on the lookup columns
+    db.execute('CREATE INDEX [ix_%s_lookup] ON [%s] (%s)' % (table, table, ', '.join('[%s]' % column for column in columns)))
+
+    db.execute('INSERT OR REPLACE INTO layers VALUES (?, ?, ?, ?, ?)', (table, ','.join(columns), fid, int(rtree), time.strftime('%Y-%m-%d %H:%M:%S')))
+    db.commit()
+    return fid
+
+
+def export_layers (path, tables=None, cursor=None):
+    """
+        exports (or re-syncs) the reference layers into the SQLite file at path;
+        tables limits the export to the given table names
+    """
+    if cursor is None:
+        with get_pool().cursor() as cursor:
+            return export_layers(path, tables, cursor)
+
+    db = sqlite3.connect(path)
+    create_metadata(db)
+
+    layer_tables = list_layer_tables(cursor)
+    if tables:
+        wanted = set(local_table_name(table).upper() for table in tables)
+        layer_tables = [(table, columns) for table, columns in layer_tables if table.upper() in wanted]
+
+    for table, columns in layer_tables:
+        start = time.time()
+        rows = export_table(cursor, db, table, columns)
+        print '%s: %i features exported in %.1fs' % (table, rows, time.time() - start)
+
+    db.close()
+    return [table for table, columns in layer_tables]
+
+
+class Mirror():
+    """
+        reads the reference shapes from a local mirror created by export_layers;
+        the connection is opened per process, a connection inherited by a forked worker is not used
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.pid = None
+        self.tables = dict((name.upper(), rtree) for name, rtree in self.connect().execute('SELECT table_name, rtree FROM layers'))
+
+    def connect(self):
+        if self.db is None or self.pid != os.getpid():
+            # the mirror is only read, so the connection can be shared by the threads of a run
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.text_factory = str
+            self.pid = os.getpid()
+        return self.db
+
+    def get_table(self, table):
+        name = local_table_name(table)
+        if name.upper() not in self.tables:
+            raise MirrorException('table %s is not in the mirror %s' % (name, self.path))
+        return name
+
+    def fetch_wkb(self, table, where_clause):
+        select_statement = 'SELECT geom FROM [%s] WHERE %s' % (self.get_table(table), sqlite_predicate(where_clause))
+        rows = self.connect().execute(select_statement).fetchmany(2)
+        if len(rows) > 1:
+            print '\tmore than one polygon returned from the statement: %s' % select_statement
+            return None
+        if not rows:
+            print '\tno record returned based on statement: %s' % select_statement
+            return None
+        return str(rows[0][0])
+
+    def queryWKT(self, table, where_clause):
+        blob = self.fetch_wkb(table, where_clause)
+        return wkb.loads(blob).wkt if blob else None
+
+    def fetch_geometry(self, table, where_clause):
+        blob = self.fetch_wkb(table, where_clause)
+        return (wkb.loads(blob), len(blob)) if blob else (None, 0)
+
+    def query_bbox(self, table, minx, miny, maxx, maxy):
+        """
+            returns the geometries whose bounding box intersects the given box (uses the R-tree when available)
+        """
+        name = self.get_table(table)
+        if self.tables[name.upper()]:
+            select_statement = 'SELECT t.geom FROM [%s] t JOIN [%s_rtree] r ON t.fid = r.id WHERE r.minx <= ? AND r.maxx >= ? AND r.miny <= ? AND r.maxy >= ?' % (name, name)
+            rows = self.connect().execute(select_statement, (maxx, minx, maxy, miny))
+            return [wkb.loads(str(row[0])) for row in rows]
+
+        box = (minx, miny, maxx, maxy)
+        geometries = [wkb.loads(str(row[0])) for row in self.connect().execute('SELECT geom FROM [%s]' % name)]
+        return [geom for geom in geometries if _boxes_intersect(geom.bounds, box)]
+
+    def close(self):
+        if self.db is not None and self.pid == os.getpid():
+            self.db.close()
+        self.db = None
+
+
+def _boxes_intersect (box1, box2):
+    return box1[0] <= box2[2] and box1[2] >= box2[0] and box1[1] <= box2[3] and box1[3] >= box2[1]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='exports/syncs the GISCoreData reference layers into a local SQLite mirror')
+    parser.add_argument('path', help='SQLite file of the mirror')
+    parser.add_argument('tables', nargs='*', help='tables to export, all reference layers by default')
+    args = parser.parse_args()
+
+    exported = export_layers(args.path, args.tables)
+    if not exported:
+        print 'no reference layers found to export.'
+        sys.exit(1)
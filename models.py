@@ -1,13 +1,57 @@
 import math
-from utils import CornerDetector, queryWKT, calc_point_from_offsets, transform, meridian_zone, ensure_polygon, area
+import hashlib
+from utils import calc_point_from_offsets, transform, meridian_zone
 from shapely.wkt import dumps, loads
 from shapely.ops import cascaded_union
 from shapely.geometry import Point
+from regions import register_region
+from lookup import Lookup, queryShape
+import corners
+from corners import queryCorners
+from quality import get_quality_engine
+import metrics
 
 
 class DirectionException(Exception): pass
 
 
+# version of the calculation in the fingerprints of the stored points (see incremental.py),
+# increased when a change of the code gives other points for the same legal description
+FINGERPRINT_VERSION = 1
+
+
+class GeometryContext(object):
+    """
+        reference shapes of one record, each fetched and parsed once and shared by coordinates(),
+        assign_ref_shapes(), assign_centroid() and define_location_quality()
+
+        lookups     : {shape name: Lookup} of the record
+        full_shapes : names of the shapes needed in full, their corners are taken from the full shape
+                      instead of fetching the convex hull separately
+    """
+    def __init__(self, lookups, full_shapes=()):
+        self.lookups = lookups
+        self.full_shapes = full_shapes
+        self.shapes = {}
+        self.corners = {}
+
+    def shape(self, name):
+        # None if the record has no such lookup or the lookup did not return a single polygon
+        if name not in self.shapes:
+            self.shapes[name] = queryShape(self.lookups[name]) if name in self.lookups else None
+        return self.shapes[name]
+
+    def four_corners(self, name):
+        # same results as queryCorners: None if the polygon was not found, [] if no corners could be extracted
+        if name not in self.corners:
+            if name in self.full_shapes:
+                polygon = self.shape(name)
+                self.corners[name] = queryCorners(self.lookups[name], polygon=polygon) if polygon else None
+            else:
+                self.corners[name] = queryCorners(self.lookups[name])
+        return self.corners[name]
+
+
 class LegalDescription(object):
 
     def __init__(self, rec):
@@ -23,6 +67,11 @@ class LegalDescription(object):
         self.reference_shapes = None
         self.offset_1 = None
         self.offset_2 = None
+        self.offset_dir_1 = None
+        self.offset_dir_2 = None
+        self.legal_desc_read = False
+        self.ref_lookups = None
+        self.geometry_context = None
 
     def store_calculated_point_and_QA(self):
         if self.point:
@@ -31,7 +80,19 @@ class LegalDescription(object):
             self.rec.coo.epsg_code = 4269  # NAD83
             self.rec.coo.loc_quality = self.get_location_quality()
         else:
-            print 'point was not calculated.'
+            self.outcome(metrics.NOT_CALCULATED, 'point was not calculated.')
+
+    def outcome(self, code, detail=None, shape=None):
+        # counts the outcome of the record for its region, against the table of the reference shape if one is given
+        if shape is not None and shape in self.reference_lookups():
+            metrics.outcome(code, detail, region=self.__class__.__name__, table=self.reference_lookups()[shape].table)
+        else:
+            metrics.outcome(code, detail, region=self.__class__.__name__)
+
+    def get_result(self):
+        # compact result of the calculation: (WellBoreDetail id, CoordinateID, lon, lat, epsg, location quality)
+        if self.point:
+            return (self.rec.wbd.id, self.rec.coo.id, self.point.x, self.point.y, 4269, self.get_location_quality())
 
     def get_original_calculated_distance(self):
         if all([self.point, self.orig_point]):
@@ -60,9 +121,74 @@ class LegalDescription(object):
         except:
             return Point(0,0)
 
+    def read_legal_description(self):
+        # reads the legal description columns of the record only once (prefetching and coordinates() both need them)
+        if not self.legal_desc_read:
+            self.legal_desc_read = True
+            self.parse_legal_description()
+
+    def parse_legal_description(self):
+        # implemented by the models that calculate the point from the legal description
+        pass
+
+    def reference_lookups(self):
+        """
+            returns the lookups of the reference shapes used by the model: {shape name: Lookup}
+        """
+        if self.ref_lookups is None:
+            self.read_legal_description()
+            self.ref_lookups = self.build_reference_lookups()
+        return self.ref_lookups
+
+    def build_reference_lookups(self):
+        return {}
+
+    def legal_description_key(self):
+        """
+            normalized legal description: the model, the keys of the reference lookups (the legal description columns
+            they are matched on) and the parsed offsets with their directions; records with equal keys get the same result
+        """
+        lookups = tuple(sorted((name, lookup.key()) for name, lookup in self.reference_lookups().iteritems()))
+        return (self.__class__.__name__, lookups, self.offset_1, self.offset_dir_1, self.offset_2, self.offset_dir_2)
+
+    def fingerprint(self):
+        # digest of the inputs the point is calculated from: the legal description, the calculation version and the settings
+        return hashlib.sha1(repr((FINGERPRINT_VERSION, corners.HULL_TOLERANCE, self.legal_description_key()))).hexdigest()
+
+    def get_memo_result(self):
+        # the calculated part of the record, shared with the records of the same legal description (see memo.py);
+        # the reference shapes are left out, the memo would keep every geometry it has seen alive
+        return self.point, self.location_quality, self.centroid_assigned
+
+    def set_memo_result(self, result):
+        self.point, self.location_quality, self.centroid_assigned = result
+
+    # name of the reference lookup whose four corners the point is calculated from
+    corner_shape = None
+
+    def corner_lookups(self):
+        lookup = self.reference_lookups().get(self.corner_shape)
+        return [lookup] if lookup else []
+
+    def shape_names(self):
+        # names of the reference shapes needed in full by assign_ref_shapes (location quality, centroid)
+        return self.reference_lookups().keys()
+
+    def shape_lookups(self):
+        lookups = self.reference_lookups()
+        return [lookups[name] for name in self.shape_names()]
+
+    def geometry(self):
+        """
+            returns the record's GeometryContext
+        """
+        if self.geometry_context is None:
+            self.geometry_context = GeometryContext(self.reference_lookups(), self.shape_names())
+        return self.geometry_context
+
     def coordinates(self):
         # ony callsed for classes that have coordinates entered manually or imported
-        print 'LegalDescription.coordinates method called.'
+        self.outcome(metrics.UNSUPPORTED_REGION, 'LegalDescription.coordinates method called.')
         pass
 
     def get_5d_api(self):
@@ -71,7 +197,7 @@ class LegalDescription(object):
         if len(_5d_api) == 5:
             return _5d_api
         else:
-            print 'incorrect 5 digit api: %s' % _5d_api
+            self.outcome(metrics.INVALID_API, 'incorrect 5 digit api: %s' % _5d_api)
             return '00000'
 
     def get_point(self):
@@ -108,18 +234,21 @@ class LegalDescription(object):
             return 0
 
         score = self.location_quality
-        for name, shape in self.reference_shapes.iteritems():
+        point_wm = transform(4269, 3857, self.point)
+        lookups = self.reference_lookups()
+        engine = get_quality_engine()
+        for name, shape in (self.reference_shapes or {}).iteritems():
             try:
-                shape = ensure_polygon(shape)
+                shape = engine.prepare(lookups[name].key() if name in lookups else None, shape)
 
-                if shape.intersection(transform(4269, 3857, self.point)): 
-                    score += math.pow(area(shape, units='square miles'), -1)  # if within a square mile => score = 1
-                    # print '\tpoint inside the shape: %s, area: %.3f square miles' % (name, area(shape, units='square miles'))
+                if shape.intersects(point_wm):
+                    score += math.pow(shape.area_sq_miles, -1)  # if within a square mile => score = 1
+                    # print '\tpoint inside the shape: %s, area: %.3f square miles' % (name, shape.area_sq_miles)
                 else:
                     pass
                     # print '\tpoint outside the shape: %s' % name
             except:
-                print '\tinvalid geomtery for %s' % name
+                self.outcome(metrics.INVALID_GEOMETRY, '\tinvalid geomtery for %s' % name, shape=name)
 
         # reset score if the point does not fall within any of the related shapes
         if score == self.location_quality:
@@ -144,13 +273,20 @@ class LegalDescription_Canada(LegalDescription):
         self.province_code = self.rec.sta.state_code.upper().strip()
         self.uwi = rec.wb.uwi.strip()
 
+    def shape_names(self):
+        # assign_ref_shapes does not use the reference shapes, only the corners are needed
+        return []
 
+
+@register_region('texas', ('TX',))
 class Texas(LegalDescription_USA):
 
+    corner_shape = 'Abstract'
+
     def __init__(self, rec):
         super(Texas, self).__init__(rec)
 
-    def coordinates(self):
+    def parse_legal_description(self):
         # variables
         self.abstract_no = self.rec.geo.abstract_number.strip()
         self.offset_dir_1 = self.rec.geo.offset_dir_1.upper().strip()
@@ -159,56 +295,57 @@ class Texas(LegalDescription_USA):
             self.offset_1 = float(self.rec.geo.offset_1)
             self.offset_2 = float(self.rec.geo.offset_2)
         except:
-            print '\tCould not convert offsets to float: %s, %s' % (self.rec.geo.offset_1, self.rec.geo.offset_2) 
+            self.outcome(metrics.INVALID_OFFSETS, '\tCould not convert offsets to float: %s, %s' % (self.rec.geo.offset_1, self.rec.geo.offset_2))
 
         self.legal_desc_str = '\tloc#: %s, api: %s, state: %s, county: %s, abstract no: %s, offset1: %s, offsetDir1: %s, offset2: %s, offsetDir2: %s' \
                 % (self.locnum, self.api, self.state_code, self.county, self.abstract_no, self.offset_1, self.offset_dir_1, self.offset_2, self.offset_dir_2)
 
+    def build_reference_lookups(self):
+        return {
+            'Api_region'    : Lookup('GISCoreData.dbo.API_Regions_WM', [('FIPS_API', self.get_5d_api())]),
+            'Abstract'      : Lookup('GISCoreData.dbo.TexasSurveys', [('COUNTY', self.county), ('ANUM1', self.abstract_no)]),
+        }
+
+    def coordinates(self):
+        self.read_legal_description()
+
         # if data necessary for calculation is missing, return
         if not all([self.county, self.abstract_no, self.offset_1, self.offset_2, self.offset_dir_1, self.offset_dir_2]):
             # self.point is None, assigned in constructor
-            print '\tmissing crucial data in legal description to calculate the point location.'
+            self.outcome(metrics.MISSING_LEGAL_DESCRIPTION, '\tmissing crucial data in legal description to calculate the point location.')
             return
 
-        where_clause = "COUNTY LIKE '%s' AND ANUM1 LIKE '%s'" % (self.county, self.abstract_no)
-        table = 'GISCoreData.dbo.TexasSurveys'
-        wkt = queryWKT(table, where_clause)
+        lookup = self.reference_lookups()[self.corner_shape]
+        four_corners = self.geometry().four_corners(self.corner_shape)
 
         # at this point we skip records that have directions specified like FWSEL,...
         # or the polygon was not retreived
-        if not wkt: 
+        if four_corners is None:
             # self.point is None, assigned in constructor
-            print '\tCould not retrieve the referenced polygon based on query: %s' % where_clause
+            self.outcome(metrics.POLYGON_NOT_FOUND, '\tCould not retrieve the referenced polygon based on query: %s' % lookup.where_clause(), shape=self.corner_shape)
             return  
             
-        # print wkt
-        detector = CornerDetector(wkt)
-        if detector.get_four_corners():
-            # print detector
-            self.point = calc_point_from_offsets(detector.get_four_corners(), self.offset_1, self.offset_dir_1, self.offset_2, self.offset_dir_2, units='feet')
+        if four_corners:
+            # print four_corners
+            self.point = calc_point_from_offsets(four_corners, self.offset_1, self.offset_dir_1, self.offset_2, self.offset_dir_2, units='feet')
 
         else:
-            print '\tunable to extract four corners from the referenced shape'
+            self.outcome(metrics.NO_FOUR_CORNERS, '\tunable to extract four corners from the referenced shape', shape=self.corner_shape)
 
     def assign_ref_shapes(self):
         
         # dictionary that containes pairs rank: Polygon
         _shapes = {}
+        geometry = self.geometry()
 
         # extract API region
-        where_clause = "FIPS_API = '%s'" % (self.get_5d_api())
-        table = 'GISCoreData.dbo.API_Regions_WM'
-        polygon_WKT = queryWKT(table, where_clause)
-        if polygon_WKT: 
-            poly = loads(polygon_WKT)
+        poly = geometry.shape('Api_region')
+        if poly: 
             _shapes['Api_region'] = poly
 
         #exctract Abstract
-        where_clause = "COUNTY = '%s' AND ANUM1 = '%s'" % (self.county.upper().strip(), self.abstract_no.strip())
-        table = 'GISCoreData.dbo.TexasSurveys'
-        polygon_WKT = queryWKT(table, where_clause)
-        if polygon_WKT: 
-            poly = loads(polygon_WKT)
+        poly = geometry.shape('Abstract')
+        if poly: 
             _shapes['Abstract'] = poly
 
         #TODO: add more conditions
@@ -219,6 +356,7 @@ class Texas(LegalDescription_USA):
         # print '\tlocation quality: %s' % location_quality_score
 
 
+@register_region('ohio_virginia', ('OH', 'VA'))
 class Ohio_Virginia(LegalDescription_USA):
 
     def __init__(self, rec):
@@ -226,46 +364,53 @@ class Ohio_Virginia(LegalDescription_USA):
 
 
     def coordinates(self):
-        print 'calculating coordinates for %s (%s)' % (self.rec.sta.state_code,self.__class__.__name__)
+        self.outcome(metrics.UNSUPPORTED_REGION, 'calculating coordinates for %s (%s)' % (self.rec.sta.state_code,self.__class__.__name__))
         abstract = self.rec
 
 
+@register_region('kentucky_tennessee', ('KY', 'TN'))
 class Kentucky_Tennessee(LegalDescription_USA):
 
     def __init__(self, rec):
         super(Kentucky_Tennessee, self).__init__(rec)
 
     def coordinates(self):
-        print 'calculating coordinates for %s (%s)' % (self.rec.sta.state_code,self.__class__.__name__)
+        self.outcome(metrics.UNSUPPORTED_REGION, 'calculating coordinates for %s (%s)' % (self.rec.sta.state_code,self.__class__.__name__))
         abstract = self.rec
 
 
+@register_region('new_york', ('NY',))
 class NewYork(LegalDescription_USA):
 
     def __init__(self, rec):
         super(NewYork, self).__init__(rec)
 
     def coordinates(self):
-        print 'calculating coordinates for %s (%s)' % (self.rec.sta.state_code,self.__class__.__name__)
+        self.outcome(metrics.UNSUPPORTED_REGION, 'calculating coordinates for %s (%s)' % (self.rec.sta.state_code,self.__class__.__name__))
         abstract = self.rec
 
 
+@register_region('wv_pensylvania', ('WV', 'PA'))
 class WV_Pensylvania(LegalDescription_USA):
 
     def __init__(self, rec):
         super(WV_Pensylvania, self).__init__(rec)
 
     def coordinates(self):
-        print 'calculating coordinates for %s (%s)' % (self.rec.sta.state_code,self.__class__.__name__)
+        self.outcome(metrics.UNSUPPORTED_REGION, 'calculating coordinates for %s (%s)' % (self.rec.sta.state_code,self.__class__.__name__))
         abstract = self.rec
 
 
+@register_region('pls', ('AK', 'AL', 'AR', 'AZ', 'CA', 'CO', 'FL', 'ID', 'IL', 'IN', 'KS', 'LA', 'MA', 'MI',
+                         'MN', 'MO', 'MS', 'MT', 'ND', 'NE', 'NM', 'NV', 'OK', 'SD', 'UT', 'VT', 'WA', 'WI', 'WY', 'ZG'))
 class PLS(LegalDescription_USA):
 
+    corner_shape = 'Section'
+
     def __init__(self, rec):
         super(PLS, self).__init__(rec)
 
-    def coordinates(self):
+    def parse_legal_description(self):
         # variables
         self.mcode1 = self.rec.cty.mcode1
         self.mcode2 = self.rec.cty.mcode2
@@ -287,7 +432,7 @@ class PLS(LegalDescription_USA):
             self.offset_1 = float(self.rec.geo.offset_1)
             self.offset_2 = float(self.rec.geo.offset_2)
         except:
-            print '\tCould not convert offsets to float: %s, %s' % (self.rec.geo.offset_1, self.rec.geo.offset_2) 
+            self.outcome(metrics.INVALID_OFFSETS, '\tCould not convert offsets to float: %s, %s' % (self.rec.geo.offset_1, self.rec.geo.offset_2))
 
 
         # define the meridian zone
@@ -301,55 +446,61 @@ class PLS(LegalDescription_USA):
                         self.twnshp, self.twnshp_dir, self.range_, self.range_dir, self.section, self.qsection, self.qqsection,
                         self.offset_1, self.offset_dir_1, self.offset_2, self.offset_dir_2)
 
+    def build_reference_lookups(self):
+        section_columns = [('TWN', self.twnshp), ('TWNDIR', self.twnshp_dir), ('RNG', self.range_), ('RNGDIR', self.range_dir), ('SECTION', self.section)]
+        lookups = {
+            'Api_region'    : Lookup('GISCoreData.dbo.API_Regions_WM', [('FIPS_API', self.get_5d_api())]),
+            'Section'       : Lookup('GISCoreData.dbo.PLSS_SEC_%i' % self.mcode, [('StateCode', self.state_code)] + section_columns),
+        }
+
+        # qqsection if exists
+        if self.qqsection:
+            lookups['qqSection'] = Lookup('GISCoreData.dbo.PLSS_QQ_%i' % self.mcode, section_columns + [('qqsection', '%s%s' % (self.qsection, self.qqsection))])
+
+        return lookups
+
+    def coordinates(self):
+        self.read_legal_description()
+
         if not all([self.state_code, self.county, self.twnshp, self.twnshp_dir, self.range_, self.range_dir, self.section, self.offset_1, self.offset_2, self.offset_dir_1, self.offset_dir_2]):
             # self.point is None, assigned in constructor
+            self.outcome(metrics.MISSING_LEGAL_DESCRIPTION)
             return
 
-        where_clause = "StateCode LIKE '%s' AND TWN LIKE '%s' AND TWNDIR LIKE '%s' AND RNG LIKE '%s' AND RNGDIR LIKE '%s'AND SECTION LIKE '%s'" % (self.state_code, self.twnshp, self.twnshp_dir, self.range_, self.range_dir, self.section)
-        table = 'GISCoreData.dbo.PLSS_SEC_%i' % self.mcode
-        wkt = queryWKT(table, where_clause)
+        four_corners = self.geometry().four_corners(self.corner_shape)
 
-        if not wkt or len(self.offset_dir_1) > 3 or len(self.offset_dir_2) > 3: 
+        if four_corners is None or len(self.offset_dir_1) > 3 or len(self.offset_dir_2) > 3: 
             # self.point is None, assigned in constructor
+            self.outcome(metrics.POLYGON_NOT_FOUND if four_corners is None else metrics.UNKNOWN_DIRECTION, shape=self.corner_shape)
             return
             
-        # print wkt
-        detector = CornerDetector(wkt)
-        if detector.get_four_corners():
-            # print detector
-            self.point = calc_point_from_offsets(detector.get_four_corners(), self.offset_1, self.offset_dir_1, self.offset_2, self.offset_dir_2, units='feet')
+        if four_corners:
+            # print four_corners
+            self.point = calc_point_from_offsets(four_corners, self.offset_1, self.offset_dir_1, self.offset_2, self.offset_dir_2, units='feet')
 
         else:
-            print '\tunable to extract four corners from the referenced shape'
+            self.outcome(metrics.NO_FOUR_CORNERS, '\tunable to extract four corners from the referenced shape', shape=self.corner_shape)
 
     def assign_ref_shapes(self):
 
         # dictionary that containes pairs rank: Polygon
         _shapes = {}
+        geometry = self.geometry()
 
         # extract API region
-        where_clause = "FIPS_API = '%s'" % (self.get_5d_api())
-        table = 'GISCoreData.dbo.API_Regions_WM'
-        polygon_WKT = queryWKT(table, where_clause)
-        if polygon_WKT: 
-            poly = loads(polygon_WKT)
+        poly = geometry.shape('Api_region')
+        if poly: 
             _shapes['Api_region'] = poly
 
         #exctract section
-        where_clause = "StateCode LIKE '%s' AND TWN LIKE '%s' AND TWNDIR LIKE '%s' AND RNG LIKE '%s' AND RNGDIR LIKE '%s'AND SECTION LIKE '%s'" % (self.state_code, self.twnshp, self.twnshp_dir, self.range_, self.range_dir, self.section)
-        table = 'GISCoreData.dbo.PLSS_SEC_%i' % self.mcode
-        polygon_WKT = queryWKT(table, where_clause)
-        if polygon_WKT: 
-            poly = loads(polygon_WKT)
+        poly = geometry.shape('Section')
+        if poly: 
             _shapes['Section'] = poly
 
         # qqsection if exists
-        if self.qqsection:
-            where_clause = "TWN LIKE '%s' AND TWNDIR LIKE '%s' AND RNG LIKE '%s' AND RNGDIR LIKE '%s'AND SECTION LIKE '%s' AND qqsection like '%s%s'" % (self.twnshp, self.twnshp_dir, self.range_, self.range_dir, self.section, self.qsection, self.qqsection)
-            table = 'GISCoreData.dbo.PLSS_QQ_%i' % self.mcode
-            polygon_WKT = queryWKT(table, where_clause)
-            if polygon_WKT: 
-                poly = loads(polygon_WKT)
+        if 'qqSection' in self.reference_lookups():
+            poly = geometry.shape('qqSection')
+            if poly: 
                 _shapes['qqSection'] = poly
 
         #TODO: add more conditions
@@ -357,12 +508,15 @@ class PLS(LegalDescription_USA):
         self.reference_shapes = _shapes
 
 
+@register_region('british_columbia_dls', ('BC',), uwi_prefix='1')
 class British_Columbia_dls(LegalDescription_Canada):
 
+    corner_shape = 'Section'
+
     def __init__(self, rec):
         super(British_Columbia_dls, self).__init__(rec)
 
-    def coordinates(self):
+    def parse_legal_description(self):
 
         # variables
 
@@ -381,49 +535,59 @@ class British_Columbia_dls(LegalDescription_Canada):
             self.offset_1 = float(self.rec.geo.offset_1)
             self.offset_2 = float(self.rec.geo.offset_2)
         except:
-            print '\tCould not convert offsets to float: %s, %s' % (self.rec.geo.offset_1, self.rec.geo.offset_2) 
+            self.outcome(metrics.INVALID_OFFSETS, '\tCould not convert offsets to float: %s, %s' % (self.rec.geo.offset_1, self.rec.geo.offset_2))
 
         self.legal_desc_str = '\tloc#: %s, uwi: %s, province: %s, meridian: %s, twn: %s, rng: %s, section: %s, lsd: %s, offset1: %s, offset2: %s' \
                 % (self.locnum, self.uwi, self.province_code, self.meridian, self.twnshp, self.range_, self.section, self.lsd, self.offset_1, self.offset_2)
 
+    def build_reference_lookups(self):
+        return {
+            'Section'       : Lookup('GISCoreData.dbo.DLS_%s_SEC' % self.province_code, [('MER', self.meridian), ('TWN', int(self.twnshp)), ('RNG', int(self.range_)), ('SEC', int(self.section))]),
+        }
+
+    def coordinates(self):
+        self.read_legal_description()
+
         if not all([self.province_code, self.meridian, self.twnshp, self.range_, self.section, self.offset_1, self.offset_2]):
             # self.point is None, assigned in constructor
+            self.outcome(metrics.MISSING_LEGAL_DESCRIPTION)
             return
 
-        where_clause = "MER = '%s' AND TWN = %i AND RNG = %i AND SEC = %i" % (self.meridian, int(self.twnshp), int(self.range_), int(self.section))
-        table = 'GISCoreData.dbo.DLS_%s_SEC' % self.province_code
-        wkt = queryWKT(table, where_clause)
+        four_corners = self.geometry().four_corners(self.corner_shape)
 
-        if not wkt: 
+        if four_corners is None:
             # self.point is None, assigned in constructor
+            self.outcome(metrics.POLYGON_NOT_FOUND, shape=self.corner_shape)
             return
             
-        # print wkt
-        detector = CornerDetector(wkt)
-        if detector.get_four_corners():
+        if four_corners:
 
             # directions are determined from the offset values.
             offset_dir_1 = 'FSL' if self.offset_1 > 0 else 'FNL'
             offset_dir_2 = 'FWL' if self.offset_2 > 0 else 'FEL'
 
-            # print detector
-            self.point = calc_point_from_offsets(detector.get_four_corners(), abs(self.offset_1), offset_dir_1, abs(self.offset_2), offset_dir_2, units='meters')
+            # print four_corners
+            self.point = calc_point_from_offsets(four_corners, abs(self.offset_1), offset_dir_1, abs(self.offset_2), offset_dir_2, units='meters')
 
         else:
-            print '\tunable to extract four corners from the referenced shape'
+            self.outcome(metrics.NO_FOUR_CORNERS, '\tunable to extract four corners from the referenced shape', shape=self.corner_shape)
 
     def assign_ref_shapes(self):
 
-        print '\tassigning reference shapes...'
+        # print '\tassigning reference shapes...'
+        pass
 
 
+@register_region('british_columbia_ts', ('BC',), uwi_prefix='2')
 class British_Columbia_ts(LegalDescription_Canada):
 
+    corner_shape = 'Unit'
+
     def __init__(self, rec):
 
         super(British_Columbia_ts, self).__init__(rec)
 
-    def coordinates(self):
+    def parse_legal_description(self):
 
         # variables
         self.map_sheet = self.rec.geo.map_sheet.strip()
@@ -437,48 +601,58 @@ class British_Columbia_ts(LegalDescription_Canada):
             self.offset_1 = float(self.rec.geo.offset_1)
             self.offset_2 = float(self.rec.geo.offset_2)
         except:
-            print '\tCould not convert offsets to float: %s, %s' % (self.rec.geo.offset_1, self.rec.geo.offset_2) 
+            self.outcome(metrics.INVALID_OFFSETS, '\tCould not convert offsets to float: %s, %s' % (self.rec.geo.offset_1, self.rec.geo.offset_2))
 
         self.legal_desc_str = '\tloc#: %s, uwi: %s, province: %s, mapsheet: %s, block: %s, unit: %s, qunit: %s, offset_NS: %s, offset_EW: %s' \
                 % (self.locnum, self.uwi, self.province_code, self.map_sheet, self.block, self.unit, self.quarter_unit, self.offset_1, self.offset_2)
 
+    def build_reference_lookups(self):
+        return {
+            'Unit'          : Lookup('GISCoreData.dbo.TS_%s_UNITS' % self.province_code, [('MAPSHEET', self.map_sheet), ('BLOCK', self.block), ('UNIT', int(self.unit))]),
+        }
+
+    def coordinates(self):
+        self.read_legal_description()
+
         if not all([self.province_code, self.map_sheet, self.block, self.unit, self.quarter_unit, self.offset_1, self.offset_2]):
             # self.point is None, assigned in constructor
+            self.outcome(metrics.MISSING_LEGAL_DESCRIPTION)
             return
 
-        where_clause = "MAPSHEET = '%s' AND BLOCK = '%s' AND UNIT = %i" % (self.map_sheet, self.block, int(self.unit))
-        table = 'GISCoreData.dbo.TS_%s_UNITS' % self.province_code
-        wkt = queryWKT(table, where_clause)
+        four_corners = self.geometry().four_corners(self.corner_shape)
 
-        if not wkt: 
+        if four_corners is None:
             # self.point is None, assigned in constructor
+            self.outcome(metrics.POLYGON_NOT_FOUND, shape=self.corner_shape)
             return
             
-        # print wkt
-        detector = CornerDetector(wkt)
-        if detector.get_four_corners():
+        if four_corners:
 
             # directions are determined from the offset values.
             offset_dir_1 = 'FSL' if self.offset_1 > 0 else 'FNL'
             offset_dir_2 = 'FWL' if self.offset_2 > 0 else 'FEL'
 
             # the offset values are passed as positive values to the calc_point_from_offset funcion
-            self.point = calc_point_from_offsets(detector.get_four_corners(), abs(self.offset_1), offset_dir_1, abs(self.offset_2), offset_dir_2, units='meters')
+            self.point = calc_point_from_offsets(four_corners, abs(self.offset_1), offset_dir_1, abs(self.offset_2), offset_dir_2, units='meters')
 
         else:
-            print '\tunable to extract four corners from the referenced shape'
+            self.outcome(metrics.NO_FOUR_CORNERS, '\tunable to extract four corners from the referenced shape', shape=self.corner_shape)
 
     def assign_ref_shapes(self):
         pass
 
 
+# there are no known topographic survey records for Alberta
+# @register_region('alberta_ts', ('AB',), uwi_prefix='2')
 class Alberta_ts(LegalDescription_Canada):
 
+    corner_shape = 'Unit'
+
     def __init__(self, rec):
 
         super(Alberta_ts, self).__init__(rec)
 
-    def coordinates(self):
+    def parse_legal_description(self):
 
         # variables
         self.map_sheet = self.rec.geo.map_sheet.strip()
@@ -492,45 +666,55 @@ class Alberta_ts(LegalDescription_Canada):
             self.offset_1 = float(self.rec.geo.offset_1)
             self.offset_2 = float(self.rec.geo.offset_2)
         except:
-            print '\tCould not convert offsets to float: %s, %s' % (self.rec.geo.offset_1, self.rec.geo.offset_2) 
+            self.outcome(metrics.INVALID_OFFSETS, '\tCould not convert offsets to float: %s, %s' % (self.rec.geo.offset_1, self.rec.geo.offset_2))
 
         self.legal_desc_str = '\tloc#: %s, uwi: %s, province: %s, mapsheet: %s, block: %s, unit: %s, qunit: %s, offset_1: %s, offset_dir_1: %s, offset_2: %s, offset_dir_2: %s' \
                 % (self.locnum, self.uwi, self.province_code, self.map_sheet, self.block, self.unit, self.quarter_unit, self.offset_1, self.offset_dir_1, self.offset_2, self.offset_dir_2)
 
+    def build_reference_lookups(self):
+        return {
+            'Unit'          : Lookup('GISCoreData.dbo.TS_%s_UNITS' % self.province_code, [('MAPSHEET', self.map_sheet), ('BLOCK', self.block), ('UNIT', int(self.unit))]),
+        }
+
+    def coordinates(self):
+        self.read_legal_description()
+
         if not all([self.province_code, self.map_sheet, self.block, self.unit, self.quarter_unit, self.offset_1, self.offset_2]):
             # self.point is None, assigned in constructor
+            self.outcome(metrics.MISSING_LEGAL_DESCRIPTION)
             return
 
-        where_clause = "MAPSHEET = '%s' AND BLOCK = '%s' AND UNIT = %i" % (self.map_sheet, self.block, int(self.unit))
-        table = 'GISCoreData.dbo.TS_%s_UNITS' % self.province_code
-        wkt = queryWKT(table, where_clause)
+        four_corners = self.geometry().four_corners(self.corner_shape)
 
-        if not wkt: 
+        if four_corners is None:
             # self.point is None, assigned in constructor
+            self.outcome(metrics.POLYGON_NOT_FOUND, shape=self.corner_shape)
             return
             
-        # print wkt
-        detector = CornerDetector(wkt)
-        if detector.get_four_corners():
+        if four_corners:
 
             # the offset values are passed as positive values to the calc_point_from_offset funcion
-            self.point = calc_point_from_offsets(detector.get_four_corners(), abs(self.offset_1), offset_dir_1, abs(self.offset_2), offset_dir_2, units='meters')
+            self.point = calc_point_from_offsets(four_corners, abs(self.offset_1), offset_dir_1, abs(self.offset_2), offset_dir_2, units='meters')
 
         else:
-            print '\tunable to extract four corners from the referenced shape'
+            self.outcome(metrics.NO_FOUR_CORNERS, '\tunable to extract four corners from the referenced shape', shape=self.corner_shape)
 
     def assign_ref_shapes(self):
         pass
 
 
+@register_region('alberta_saskatchewan_dls', ('AB',), uwi_prefix='1')
+@register_region('alberta_saskatchewan_dls', ('SK',))
 class Alberta_Saskatchewan_dls(LegalDescription_Canada):
 
+    corner_shape = 'Section'
+
     flip_directions = {'FEL': 'FWL', 'FSL': 'FNL', 'FWL': 'FEL', 'FNL': 'FSL'}
 
     def __init__(self, rec):
         super(Alberta_Saskatchewan_dls, self).__init__(rec)
 
-    def coordinates(self):
+    def parse_legal_description(self):
 
         # variables
 
@@ -549,7 +733,7 @@ class Alberta_Saskatchewan_dls(LegalDescription_Canada):
             self.offset_1 = float(self.rec.geo.offset_1)
             self.offset_2 = float(self.rec.geo.offset_2)
         except:
-            print '\tCould not convert offsets to float: %s, %s' % (self.rec.geo.offset_1, self.rec.geo.offset_2) 
+            self.outcome(metrics.INVALID_OFFSETS, '\tCould not convert offsets to float: %s, %s' % (self.rec.geo.offset_1, self.rec.geo.offset_2))
 
         # flip directions: because the source directions for Canada (SK, AB and MB)are just entered the opposite what they should have been
         self.offset_dir_1 = Alberta_Saskatchewan_dls.flip_directions.get(self.offset_dir_1)
@@ -561,38 +745,47 @@ class Alberta_Saskatchewan_dls(LegalDescription_Canada):
         self.legal_desc_str = '\tloc#: %s, uwi: %s, province: %s, meridian: %s, twn: %s, rng: %s, section: %s, lsd: %s, offset1: %.2f, offset_dir1: %s, offset2: %.2f, offset_dir2: %s' \
                 % (self.locnum, self.uwi, self.province_code, self.meridian, self.twnshp, self.range_, self.section, self.lsd, self.offset_1, self.offset_dir_1, self.offset_2, self.offset_dir_2)
 
+    def build_reference_lookups(self):
+        return {
+            'Section'       : Lookup('GISCoreData.dbo.DLS_%s_SEC' % self.province_code, [('MER', self.meridian), ('TWN', self.twnshp), ('RNG', self.range_), ('SEC', self.section)]),
+        }
+
+    def coordinates(self):
+        self.read_legal_description()
+
         if not all([self.province_code, self.meridian, self.twnshp, self.range_, self.section, self.offset_1, self.offset_dir_1, self.offset_2, self.offset_dir_2]):
             # self.point is None, assigned in constructor
+            self.outcome(metrics.MISSING_LEGAL_DESCRIPTION)
             return
 
-        where_clause = "MER = '%s' AND TWN = '%s' AND RNG = '%s' AND SEC = '%s'" % (self.meridian, self.twnshp, self.range_, self.section)
-        table = 'GISCoreData.dbo.DLS_%s_SEC' % self.province_code
-        wkt = queryWKT(table, where_clause)
+        four_corners = self.geometry().four_corners(self.corner_shape)
 
-        if not wkt: 
+        if four_corners is None:
             # self.point is None, assigned in constructor
+            self.outcome(metrics.POLYGON_NOT_FOUND, shape=self.corner_shape)
             return
             
-        # print wkt
-        detector = CornerDetector(wkt)
-        if detector.get_four_corners():
+        if four_corners:
 
-            # print detector
-            self.point = calc_point_from_offsets(detector.get_four_corners(), self.offset_1, self.offset_dir_1, self.offset_2, self.offset_dir_2, units='meters')
+            # print four_corners
+            self.point = calc_point_from_offsets(four_corners, self.offset_1, self.offset_dir_1, self.offset_2, self.offset_dir_2, units='meters')
 
         else:
-            print '\tunable to extract four corners from the referenced shape'
+            self.outcome(metrics.NO_FOUR_CORNERS, '\tunable to extract four corners from the referenced shape', shape=self.corner_shape)
 
     def assign_ref_shapes(self):
         pass
 
 
+@register_region('manitoba_dls', ('MB',))
 class Manitoba_dls(LegalDescription_Canada):
 
+    corner_shape = 'Section'
+
     def __init__(self, rec):
         super(Manitoba_dls, self).__init__(rec)
 
-    def coordinates(self):
+    def parse_legal_description(self):
 
         # variables
 
@@ -611,7 +804,7 @@ class Manitoba_dls(LegalDescription_Canada):
             self.offset_1 = float(self.rec.geo.offset_1)
             self.offset_2 = float(self.rec.geo.offset_2)
         except:
-            print '\tCould not convert offsets to float: %s, %s' % (self.rec.geo.offset_1, self.rec.geo.offset_2) 
+            self.outcome(metrics.INVALID_OFFSETS, '\tCould not convert offsets to float: %s, %s' % (self.rec.geo.offset_1, self.rec.geo.offset_2))
 
         if not all([self.offset_dir_1, self.offset_dir_2]):
             raise DirectionException("Wrong direction values: (%s, %s)" % (self.rec.geo.offset_dir_1.upper().strip(), self.rec.geo.offset_dir_2.upper().strip()))
@@ -619,27 +812,33 @@ class Manitoba_dls(LegalDescription_Canada):
         self.legal_desc_str = '\tloc#: %s, uwi: %s, province: %s, meridian: %s, twn: %s, rng: %s, section: %s, lsd: %s, offset1: %.2f, offset_dir1: %s, offset2: %.2f, offset_dir2: %s' \
                 % (self.locnum, self.uwi, self.province_code, self.meridian, self.twnshp, self.range_, self.section, self.lsd, self.offset_1, self.offset_dir_1, self.offset_2, self.offset_dir_2)
 
+    def build_reference_lookups(self):
+        return {
+            'Section'       : Lookup('GISCoreData.dbo.DLS_%s_SEC' % self.province_code, [('MER', self.meridian), ('TWN', self.twnshp), ('RNG', self.range_), ('SEC', self.section)]),
+        }
+
+    def coordinates(self):
+        self.read_legal_description()
+
         if not all([self.province_code, self.meridian, self.twnshp, self.range_, self.section, self.offset_1, self.offset_dir_1, self.offset_2, self.offset_dir_2]):
             # self.point is None, assigned in constructor
+            self.outcome(metrics.MISSING_LEGAL_DESCRIPTION)
             return
 
-        where_clause = "MER = '%s' AND TWN = '%s' AND RNG = '%s' AND SEC = '%s'" % (self.meridian, self.twnshp, self.range_, self.section)
-        table = 'GISCoreData.dbo.DLS_%s_SEC' % self.province_code
-        wkt = queryWKT(table, where_clause)
+        four_corners = self.geometry().four_corners(self.corner_shape)
 
-        if not wkt: 
+        if four_corners is None:
             # self.point is None, assigned in constructor
+            self.outcome(metrics.POLYGON_NOT_FOUND, shape=self.corner_shape)
             return
             
-        # print wkt
-        detector = CornerDetector(wkt)
-        if detector.get_four_corners():
+        if four_corners:
 
-            # print detector
-            self.point = calc_point_from_offsets(detector.get_four_corners(), self.offset_1, self.offset_dir_1, self.offset_2, self.offset_dir_2, units='meters')
+            # print four_corners
+            self.point = calc_point_from_offsets(four_corners, self.offset_1, self.offset_dir_1, self.offset_2, self.offset_dir_2, units='meters')
 
         else:
-            print '\tunable to extract four corners from the referenced shape'
+            self.outcome(metrics.NO_FOUR_CORNERS, '\tunable to extract four corners from the referenced shape', shape=self.corner_shape)
 
     def assign_ref_shapes(self):
         pass
@@ -0,0 +1,41 @@
+import multiprocessing
+
+import lookup
+
+
+def partition_keys (keys, size):
+    """
+        splits the primary keys into contiguous (first key, last key) ranges of up to size distinct keys
+    """
+    keys = sorted(set(keys))
+    return [(keys[i], keys[min(i + size, len(keys)) - 1]) for i in range(0, len(keys), size)]
+
+
+# pools inherited from the parent process, referenced so their connections are never closed by the garbage collector
+_inherited_pools = []
+
+
+def init_worker (engines):
+    # connections inherited from the parent process must not be shared with it, nor closed: closing them
+    # would end the sessions of the parent on the server; the pools are replaced by empty ones
+    for engine in engines:
+        _inherited_pools.append(engine.pool)
+        engine.pool = engine.pool.recreate()
+    lookup.reset_pool()
+
+
+def run_parallel (function, partitions, processes=None, engines=()):
+    """
+        runs function(partition) for every partition in a pool of worker processes,
+        yields the results as the partitions are completed
+    """
+    pool = multiprocessing.Pool(processes, init_worker, (engines,))
+    try:
+        for result in pool.imap_unordered(function, partitions):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
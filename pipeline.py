@@ -0,0 +1,131 @@
+"""
+    overlaps the reference shape lookups with the geometry computation:
+    a pool of lookup threads, each on a connection checked out from the lookup pool, fetches the shapes of the upcoming records
+    into the geometry cache while the current record is processed
+
+    python 2 has no asyncio, the lookups run in threads around the blocking pymssql calls instead;
+    pymssql releases the GIL while it waits for the server, so up to `threads` lookups are in flight
+"""
+import Queue
+import threading
+
+import lookup
+from lookup import queryShape, queryHull, hull_key
+
+
+class Pending():
+    """
+        completion of one submitted lookup
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.error = None
+
+    def set(self, error=None):
+        self.error = error
+        self.event.set()
+
+    def done(self):
+        return self.event.is_set()
+
+    def wait(self):
+        # waits in short steps so the main thread stays interruptible
+        while not self.event.wait(1.0):
+            pass
+        return self.error
+
+
+class LookupPipeline():
+    """
+        threads   : number of lookup threads (lookups in flight)
+        window    : number of records whose lookups are submitted ahead of the record being processed
+        tolerance : Reduce tolerance of the convex hulls fetched for the corners (see lookup.queryHull)
+    """
+    def __init__(self, threads=8, window=64, tolerance=None):
+        self.threads = threads
+        self.window = window
+        self.tolerance = tolerance
+        # bounded, so the submitting thread waits instead of queueing a whole chunk of lookups
+        self.tasks = Queue.Queue(threads * 4)
+        self.inflight = {}     # cache key -> Pending of the lookups submitted for the current chunk
+        self.workers = []
+        self.lock = threading.Lock()
+        self.fetched = 0
+        self.failed = 0
+
+    def start(self):
+        for n in range(self.threads):
+            worker = threading.Thread(target=self.work, name='lookup-%i' % n)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            _lookup, hull, pending = task
+            try:
+                if hull:
+                    queryHull(_lookup, tolerance=self.tolerance)
+                else:
+                    queryShape(_lookup)
+                self.count('fetched')
+                pending.set()
+            except Exception, e:
+                # the lookup is not cached, the record repeats it when it is processed
+                self.count('failed')
+                pending.set(e)
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def submit(self, lookups):
+        """
+            lookups: [(Lookup, hull)], returns the Pendings of the lookups not cached yet
+        """
+        cache = lookup.get_geometry_cache()
+        pendings = []
+        for _lookup, hull in lookups:
+            key = hull_key(_lookup, self.tolerance) if hull else _lookup.key()
+            if key in cache or _lookup.key() in cache:
+                continue
+            pending = self.inflight.get(key)
+            if pending is None:
+                pending = self.inflight[key] = Pending()
+                self.tasks.put((_lookup, hull, pending))
+            pendings.append(pending)
+        return pendings
+
+    def ready(self, items, lookups_of):
+        """
+            yields the items in their order once the lookups of the item, lookups_of(item), are completed;
+            the lookups of the next `window` items are in flight meanwhile
+        """
+        pending_items = []
+        try:
+            for item in items:
+                pending_items.append((item, self.submit(lookups_of(item))))
+                if len(pending_items) > self.window:
+                    yield self.complete(*pending_items.pop(0))
+            while pending_items:
+                yield self.complete(*pending_items.pop(0))
+        finally:
+            self.inflight.clear()
+
+    def complete(self, item, pendings):
+        for pending in pendings:
+            pending.wait()
+        return item
+
+    def close(self):
+        for worker in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def stats(self):
+        return {'threads': self.threads, 'fetched': self.fetched, 'failed': self.failed}
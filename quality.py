@@ -0,0 +1,56 @@
+from shapely.prepared import prep
+
+from utils import ensure_polygon, area
+from lookup import GeometryCache
+
+
+class PreparedShape():
+    """
+        reference shape prepared for the location quality: the polygon (see ensure_polygon),
+        its prepared geometry for the point-in-polygon tests and its area in square miles
+    """
+    def __init__(self, geometry):
+        self.geometry = geometry
+        self.polygon = ensure_polygon(geometry)
+        self.prepared = prep(self.polygon)
+        self.area_sq_miles = area(self.polygon, units='square miles')
+
+    def intersects(self, point_wm):
+        # same as a non-empty polygon.intersection(point): points on the boundary count as inside
+        return self.prepared.intersects(point_wm)
+
+
+class QualityEngine():
+    """
+        keeps the prepared reference shapes keyed by their lookup key (table, predicate),
+        so every shape is prepared and measured once per run instead of once per record
+    """
+    def __init__(self, max_entries=10000):
+        self.shapes = GeometryCache(max_entries)
+
+    def prepare(self, key, geometry):
+        if key is None:
+            return PreparedShape(geometry)
+
+        found, shape = self.shapes.get(key)
+        # the geometry cache can hand out a re-fetched geometry for the same key
+        if not found or shape.geometry is not geometry:
+            shape = PreparedShape(geometry)
+            self.shapes.put(key, shape)
+        return shape
+
+    def stats(self):
+        return self.shapes.stats()
+
+
+_quality_engine = QualityEngine()
+
+
+def get_quality_engine():
+    return _quality_engine
+
+
+def configure_quality_engine(max_entries=10000):
+    global _quality_engine
+    _quality_engine = QualityEngine(max_entries)
+    return _quality_engine
@@ -0,0 +1,68 @@
+class RegionException(Exception): pass
+
+
+class Region(object):
+    """
+    defining regions where different coordinate calculation logic applies
+
+    """
+    def __init__(self, name, state_codes, model, uwi_prefix=None):
+        self.name = name
+        self.state_codes = tuple(code.upper() for code in state_codes)
+        self.model = model
+        self.uwi_prefix = uwi_prefix
+
+    def get_name(self):
+        return self.name
+
+    def get_criteria(self):
+        return self.state_codes, self.uwi_prefix
+
+    def get_model(self):
+        return self.model
+
+
+# dispatch tables:
+#   _regions   : state code -> Region (no UWI criteria)
+#   _prefixed  : state code -> {uwi prefix: Region} (Canadian DLS/TS split)
+_regions = {}
+_prefixed = {}
+
+
+def register_region(name, state_codes, uwi_prefix=None):
+    """
+        class decorator, registers the model class as the one handling the given state codes
+        (and optionally only the UWIs starting with uwi_prefix)
+    """
+    def decorator(model):
+        region = Region(name, state_codes, model, uwi_prefix)
+        for code in region.state_codes:
+            table = _prefixed.setdefault(code, {}) if uwi_prefix else _regions
+            key = uwi_prefix if uwi_prefix else code
+            if key in table:
+                raise RegionException('region %s already registered for %s (uwi prefix: %s)' % (table[key].get_name(), code, uwi_prefix))
+            table[key] = region
+        return model
+    return decorator
+
+
+def find_region(state_code, uwi=None):
+    """
+        returns the Region registered for the state code and UWI, None if there is none
+    """
+    state_code = state_code.upper()
+
+    prefixes = _prefixed.get(state_code)
+    if prefixes and uwi:
+        for prefix, region in prefixes.iteritems():
+            if uwi.startswith(prefix):
+                return region
+
+    return _regions.get(state_code)
+
+
+def get_regions():
+    _all = set(_regions.values())
+    for prefixes in _prefixed.values():
+        _all.update(prefixes.values())
+    return sorted(_all, key=lambda region: region.get_name())
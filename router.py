@@ -1,9 +1,25 @@
 import datetime
-from sqlalchemy import Table, MetaData, Column, Integer, Numeric, String, Date, create_engine, ForeignKey
+from collections import OrderedDict
+import argparse
+from sqlalchemy import Table, MetaData, Column, Integer, Numeric, String, Date, create_engine, ForeignKey, case
 from sqlalchemy.orm import sessionmaker, mapper, relationship, backref
 from sqlalchemy.ext.declarative import declarative_base
 
-from models import Texas, Ohio_Virginia, Kentucky_Tennessee, NewYork, WV_Pensylvania, PLS, British_Columbia_dls, British_Columbia_ts, Alberta_ts, Alberta_Saskatchewan_dls, Manitoba_dls
+import models # the model classes register their regions on import
+from regions import find_region
+from lookup import get_geometry_cache, prefetch, set_backend, configure_pool, pool_stats
+from mirror import Mirror
+import corners
+from corners import CornerIndex, set_corner_index, get_corner_index
+from parallel import partition_keys, run_parallel
+from writer import BulkWriter
+from quality import get_quality_engine
+from pipeline import LookupPipeline
+from checkpoint import Checkpoint
+from incremental import FingerprintStore, Incremental, set_incremental, get_incremental
+from memo import get_result_memo, configure_result_memo
+import metrics
+from metrics import timer
 
 Base = declarative_base()
 
@@ -14,6 +30,57 @@ meta_rigdata21 = MetaData()
 
 rigdata21_session_maker = sessionmaker(bind=engine_RigData21)
 
+# number of records streamed from the main query, prefetched and processed together
+CHUNK_SIZE = 1000
+
+# path of a local mirror of the reference layers (see mirror.py), None reads them from GISCoreData
+GIS_MIRROR = None
+
+# path of the persistent four-corner index of the reference polygons (see corners.py), None calculates the corners every time
+CORNER_INDEX = None
+
+# number of worker processes, 1 runs the records serially in this process
+PROCESSES = 1
+
+# number of threads fetching the reference shapes ahead of the processed records (see pipeline.py),
+# 0 prefetches them chunk by chunk instead; not used with a local mirror
+LOOKUP_THREADS = 0
+LOOKUP_WINDOW = 64
+
+# connection pool of the reference shape lookups: connections, seconds to wait for a free one, seconds before a connection is reopened
+GIS_POOL_SIZE = 4
+GIS_POOL_TIMEOUT = 30
+GIS_POOL_RECYCLE = 3600
+
+# files the stage timings and counters are dumped to at the end of the run (JSON, Prometheus text format), None skips them
+METRICS_JSON = None
+METRICS_PROMETHEUS = None
+
+# seconds between the progress lines (records/s, ETA), None prints none
+PROGRESS_INTERVAL = None
+
+# order the records are processed in: 'id' (WellBoreDetail id) or 'reference' (grouped by the reference polygon, see reference_order())
+ORDER = 'id'
+
+# results kept per normalized legal description, reused by the records of the same pad site (see memo.py), 0 disables it
+RESULT_MEMO_SIZE = 100000
+
+# write-back of the calculated points: rows per batch, batches per transaction and whether the transactions are committed
+WRITE_BATCH_SIZE = 1000
+WRITE_COMMIT_INTERVAL = 10
+WRITE_METHOD = 'executemany'  # or 'merge' through a staging table
+COMMIT = False
+
+# filters of the main query (see build_query), overridden by the command line
+DEFAULT_FILTERS = {
+    'states'         : ['ND'],
+    'posted_after'   : '2008-01-01',
+    'posted_before'  : '2011-01-01',
+    'wellpoint_type' : 513,
+    'first_id'       : None,
+    'last_id'        : None,
+}
+
 
 # ORM definition
 class State(Base):
@@ -121,26 +188,6 @@ class Permit(Base):
     posted_date = Column('PermitPostedDate', Date)
 
 
-class Region(object):
-    """
-    defining regions where different coordinate calculation logic applies
-
-    """
-    def __init__(self, name, criteria, model):
-        self.name = name
-        self.criteria = criteria
-        self.model = model
-
-    def get_name(self):
-        return self.name
-
-    def get_criteria(self):
-        return self.criteria
-
-    def get_model(self):
-        return self.model
-
-
 class Rec(object):
     def __init__(self, coo, geo, cty, wbd, wb, sta, prm):
         self.coo = coo
@@ -154,129 +201,450 @@ class Rec(object):
 
 def define_type(rec):
 
-    # rec.geo.abstract_number and 
-    # criteria for deciding the type
-    regions = [
-        Region(**{
-            'name'      : 'texas',
-            'criteria'  : rec.sta.state_code.upper() == 'TX',
-            'model'     : Texas(rec)
-         }),
-
-        Region(**{
-            'name'      : 'ohio_virginia',
-            'criteria'  : rec.sta.state_code.upper() in ('OH', 'VA'),
-            'model'     : Ohio_Virginia(rec)
-         }),
-
-        Region(**{
-            'name'      : 'kentucky_tennessee',
-            'criteria'  : rec.sta.state_code.upper() in ('KY', 'TN'),
-            'model'     : Kentucky_Tennessee(rec)
-         }),
-
-        Region(**{
-            'name'      : 'new_york',
-            'criteria'  : rec.sta.state_code.upper() == 'NY',
-            'model'     : NewYork(rec)
-         }),
-
-        Region(**{
-            'name'      : 'wv_pensylvania',
-            'criteria'  : rec.sta.state_code.upper() in ('WV', 'PA'),
-            'model'     : WV_Pensylvania(rec)
-         }),
-
-        Region(**{
-            'name'      : 'pls',
-            'criteria'  : rec.sta.state_code.upper() in ('AK', 'AL', 'AR', 'AZ', 'CA', 'CO', 'FL', 'ID', 'IL', 'IN', 'KS', 'LA', 'MA', 'MI', 
-                                    'MN', 'MO', 'MS', 'MT', 'ND', 'NE', 'NM', 'NV', 'OK', 'SD', 'UT', 'VT', 'WA', 'WI', 'WY', 'ZG'),
-            'model'     : PLS(rec)
-         }),
-
-        Region(**{
-            'name'      : 'british_columbia_dls',
-            'criteria'  : rec.sta.state_code.upper() == 'BC' and rec.wb.uwi.startswith('1'),
-            'model'     : British_Columbia_dls(rec)
-         }),
-
-        Region(**{
-            'name'      : 'british_columbia_ts',
-            'criteria'  : rec.sta.state_code.upper() == 'BC' and rec.wb.uwi.startswith('2'),
-            'model'     : British_Columbia_ts(rec)
-         }),    
-
-        # there are no known topographic survey records for Alberta
-        # Region(**{
-        #     'name'      : 'alberta_ts',
-        #     'criteria'  : rec.sta.state_code.upper() == 'AB' and rec.wb.uwi.startswith('2'),
-        #     'model'     : Alberta_ts(rec)
-        #  }),    
-
-        Region(**{
-            'name'      : 'alberta_saskatchewan_dls',
-            'criteria'  : (rec.sta.state_code.upper() == 'AB' and rec.wb.uwi.startswith('1') or rec.sta.state_code.upper() == 'SK'),
-            'model'     : Alberta_Saskatchewan_dls(rec)
-         }),    
-
-        Region(**{
-            'name'      : 'manitoba_dls',
-            'criteria'  : rec.sta.state_code.upper() == 'MB',
-            'model'     : Manitoba_dls(rec)
-         }),    
-    ]
-
-
-    # if criteria is fulfilled return the above Type object, including the reference to a model
-    for region in regions:
-        if region.get_criteria():
-            return region.get_model()
+    # look up the region by state code (and UWI prefix for Canada) and build only the matching model
+    region = find_region(rec.sta.state_code, rec.wb.uwi)
+    if region:
+        return region.get_model()(rec)
 
 
-if __name__ == '__main__':
-    session = rigdata21_session_maker()
+def record_ids(query, order='id', limit=None):
+    """
+        WellBoreDetail ids of the main query in processing order (see order_query), each id once
+    """
+    ids_query = order_query(query.with_entities(WellBoreDetail.id), order)
+    if limit:
+        ids_query = ids_query.limit(limit)
+    # several rows (permits) can share an id
+    return list(OrderedDict.fromkeys(row[0] for row in ids_query))
+
+
+def stream_rows(session, query, ids, order='id', chunk_size=CHUNK_SIZE):
+    """
+        yields the rows of the main query for the WellBoreDetail ids in chunks of up to chunk_size ids;
+        every chunk is read completely by its own SELECT before it is processed: the writer updates CoordinateData
+        on a second connection of this thread, with a SELECT joining CoordinateData still open on the reading connection
+        the UPDATEs would wait for its shared locks and the SELECT for the thread, a hang SQL Server does not detect;
+        the objects of a chunk are expunged from the session once it is processed,
+        so the memory stays flat no matter how many records the query returns
+    """
+    for i in range(0, len(ids), chunk_size):
+        chunk = order_query(query.filter(WellBoreDetail.id.in_(ids[i:i + chunk_size])), order).all()
+        yield chunk
+
+        for row in chunk:
+            for entity in row:
+                if entity is not None and entity in session:
+                    session.expunge(entity)
+
+
+def prefetch_reference_shapes(model_objects):
+    """
+        collects the reference shape lookups of a chunk of records and fetches them
+        with one set-based query per table into the geometry cache
+    """
+    lookups, corner_lookups = [], []
+    for model_object in model_objects:
+        shape_lookups, _corner_lookups = reference_lookups_of(model_object)
+        lookups.extend(shape_lookups)
+        corner_lookups.extend(_corner_lookups)
+    return prefetch(lookups) + prefetch(corner_lookups, hulls=True, tolerance=corners.HULL_TOLERANCE)
+
+
+def reference_lookups_of(model_object):
+    """
+        returns the lookups of the shapes the record needs in full and of the shapes it needs the corners of;
+        the corners only need the convex hulls, unless they are indexed already
+    """
+    try:
+        shape_lookups = model_object.shape_lookups()
+        corner_lookups = model_object.corner_lookups()
+    except Exception, e:
+        # counted here once: the legal description is not read again when the record is processed
+        # (see LegalDescription.read_legal_description), it goes on with the columns read before the error
+        metrics.outcome(metrics.INVALID_LEGAL_DESCRIPTION, '\tunable to define the reference shapes for loc#: %s (%s)' % (model_object.locnum, e),
+                        region=model_object.__class__.__name__)
+        return [], []
+
+    # the corners of the shapes fetched in full are taken from the full shape (see models.GeometryContext)
+    full = set(lookup.key() for lookup in shape_lookups)
+    corner_index = get_corner_index()
+    return shape_lookups, [lookup for lookup in corner_lookups if lookup.key() not in full and (corner_index is None or lookup not in corner_index)]
+
+
+def pipeline_lookups(item):
+    # lookups of a (rec, model object) pair for the lookup pipeline: [(lookup, hull)]
+    rec, model_object = item
+    if not model_object:
+        return []
+    shape_lookups, corner_lookups = reference_lookups_of(model_object)
+    return [(lookup, False) for lookup in shape_lookups] + [(lookup, True) for lookup in corner_lookups]
+
+
+def calculate_record(model_object):
+    # calculate coordinates
+    with timer('coordinates'):
+        model_object.coordinates()
+
+    # find all the referenced shapes in the legal description
+    with timer('assign_ref_shapes'):
+        model_object.assign_ref_shapes()
+
+    # assign centroid, if  unable to calculate coordinates
+    if not model_object.get_point():
+        with timer('assign_centroid'):
+            model_object.assign_centroid()
+
+    # assess the location quality
+    with timer('location_quality'):
+        model_object.define_location_quality()
+
+
+def process_record(model_object):
+    """
+        runs the coordinate pipeline for one model object, returns True if the record was reported
+    """
+
+    region = model_object.__class__.__name__
+    metrics.count('records', region=region)
+    # outcomes of the record are counted against its region
+    metrics.set_context(region=region)
+    try:
+        # a record with the same legal description was calculated already, its result is reused
+        memo = get_result_memo()
+        key = memo.key_of(model_object) if memo else None
+        found, memoized = memo.get(key) if memo else (False, None)
+        if found:
+            # the outcomes of the calculation are counted for every record of the legal description
+            result, outcomes = memoized
+            model_object.set_memo_result(result)
+            metrics.replay_outcomes(outcomes)
+            metrics.count('memo_hits', region=region)
+        else:
+            with metrics.capture_outcomes() as outcomes:
+                calculate_record(model_object)
+            if memo:
+                memo.put(key, (model_object.get_memo_result(), outcomes))
+
+        if model_object.get_centroid_assigned():
+            metrics.count('centroids', region=region)
+        elif model_object.get_point():
+            metrics.count('calculated_points', region=region)
+
+        reported = model_object.get_location_quality() < 999
+        # the full report is printed for a sample of the records only
+        if reported and metrics.show_detail('reported'):
+            with timer('report'):
+                model_object.report()
+
+        # store point and location QA into the ORM (still need to commit  in order to persist changes in the database)
+        with timer('store'):
+            model_object.store_calculated_point_and_QA()
+        return reported
+    finally:
+        # an exception of the record must not label the outcomes of the records that follow
+        metrics.clear_context()
+
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d')
+
+
+def build_query(session, filters=None):
+    """
+        main query of the records matching the filters (see DEFAULT_FILTERS), a filter set to None is not applied;
+        the dates are 'YYYY-MM-DD' strings; the posted dates bound the range exclusively, the WellBoreDetail ids inclusively
+    """
+    filters = filters or DEFAULT_FILTERS
     query = session.query(Geography, Coordinates, WellBoreDetail, WellBore, State, County, Permit)
     query = query.join(Coordinates, WellBoreDetail, WellBore, State).outerjoin(County).outerjoin(Permit)
 
-    query = query.filter(State.state_code == 'ND', Permit.posted_date < datetime.datetime(year=2011, month=1, day=1), Permit.posted_date > datetime.datetime(year=2008, month=1, day=1), WellBoreDetail.wellpoint_type_id == 513)
+    if filters.get('states'):
+        query = query.filter(State.state_code.in_(filters['states']))
+    if filters.get('posted_after'):
+        query = query.filter(Permit.posted_date > parse_date(filters['posted_after']))
+    if filters.get('posted_before'):
+        query = query.filter(Permit.posted_date < parse_date(filters['posted_before']))
+    if filters.get('wellpoint_type') is not None:
+        query = query.filter(WellBoreDetail.wellpoint_type_id == filters['wellpoint_type'])
+    if filters.get('first_id') is not None:
+        query = query.filter(WellBoreDetail.id >= filters['first_id'])
+    if filters.get('last_id') is not None:
+        query = query.filter(WellBoreDetail.id <= filters['last_id'])
     # query = query.filter(State.state_code == 'TX', WellBoreDetail.locnum == '775568')
     # query = query.filter(State.state_code == 'TX', WellBoreDetail.wellpoint_type_id == 513)
     # query = query.filter(State.state_code == 'SK', Permit.posted_date < datetime.datetime(year=2012, month=1, day=1), Permit.posted_date > datetime.datetime(year=2008, month=1, day=1), WellBore.uwi.startswith('2'))
     # print query
+    return query
 
-    j = 0 #number of reported cases
-    for i, (geo, coo, wbd, wb, sta, cty, prm) in enumerate(query.limit(10), start=1):    
-    # for i, (geo, coo, wbd, wb, sta, cty, prm) in enumerate(query, start=1):    
 
-        # if not i % 100: print '%i records processed.' % i
-        rec = Rec(coo, geo, cty, wbd, wb, sta, prm)
-        model_object = define_type(rec)
-        if model_object:
+def reference_order():
+    """
+        columns ordering the records by the reference polygon they are calculated from, so the wells of a polygon
+        are processed back to back: county / abstract (Texas), meridian zone / TWN / RNG / SEC (PLS),
+        MER / TWN / RNG / SEC (DLS), MAPSHEET / BLOCK / UNIT (TS); the columns of the other regions are NULL
 
-            # calculate coordinates
-            model_object.coordinates()
+        PLS sections are not split by the county lines, the records are ordered by the meridian zone of their county;
+        the wells of the counties spanning several zones (see utils.meridian_zone) are ordered under the first one
+    """
+    return (State.state_code, County.mcode1, case([(State.state_code == 'TX', Geography.county_id)]),
+            Geography.abstract_number, Geography.meridian,
+            Geography.map_sheet, Geography.block, Geography.unit,
+            Geography.twnshp, Geography.twnshp_dir, Geography.range_, Geography.range_dir, Geography.section,
+            WellBoreDetail.id)
 
-            # find all the referenced shapes in the legal description
-            model_object.assign_ref_shapes()
 
-            # assign centroid, if  unable to calculate coordinates
-            if not model_object.get_point():
-                model_object.assign_centroid()
+def order_query(query, order='id'):
+    if order == 'reference':
+        return query.order_by(*reference_order())
+    return query.order_by(WellBoreDetail.id)
 
-            # assess the location quality
-            model_object.define_location_quality()
-            if model_object.get_location_quality() < 999:
-                j +=1
-                model_object.report()
 
-            # store point and location QA into the ORM (still need to commit  in order to persist changes in the database)
-            model_object.store_calculated_point_and_QA()
+def process_records(chunks, writer=None, pipeline=None, checkpoint=None):
+    """
+        runs the pipeline for the chunks of rows of the main query
+        returns (#processed records, #reported records, [result tuples of the calculated points]);
+        with a writer the results are handed to it as they are calculated instead of being returned,
+        with a lookup pipeline the reference shapes are fetched by its threads while the records are processed,
+        with a checkpoint the processed records are recorded in it (the rows must be ordered by the WellBoreDetail id)
+    """
+    i = 0 #number of processed records
+    j = 0 #number of reported cases
+    results = []
+    # time spent waiting for the rows of the main query
+    for chunk in metrics.timed_iter('query', chunks):
+
+        recs = [Rec(coo, geo, cty, wbd, wb, sta, prm) for geo, coo, wbd, wb, sta, cty, prm in chunk]
+        with timer('define_type'):
+            items = [(rec, define_type(rec)) for rec in recs]
+
+        # incremental run: the records whose inputs did not change since their point was stored are skipped
+        incremental = get_incremental()
+        if incremental:
+            with timer('fingerprint'):
+                items = incremental.select(items)
+
+        if pipeline:
+            # time spent waiting for the lookup threads
+            items = metrics.timed_iter('lookup_wait', pipeline.ready(items, pipeline_lookups))
         else:
-            print 'No model found for record for %s, API: %s, UWI: %s' % (rec.sta.state_code, rec.wb.api, rec.wb.uwi)
-            print '\t', rec.wbd.locnum, rec.coo.northing, rec.coo.easting, rec.coo.epsg_code, rec.geo.legal_desc
+            # fetch the reference shapes of the whole chunk up front, one query per table
+            with timer('prefetch'):
+                prefetch_reference_shapes([model_object for rec, model_object in items if model_object])
+
+        for rec, model_object in items:
+            i += 1
+            reported = False
+            result = None
+            # if not i % 100: print '%i records processed.' % i
+            if model_object:
+                reported = process_record(model_object)
+                if reported:
+                    j += 1
+                result = model_object.get_result()
+                if result and writer:
+                    with timer('write'):
+                        writer.add_result(result)
+                elif result:
+                    results.append(result)
+            else:
+                metrics.count('records', region='unmatched')
+                metrics.outcome(metrics.NO_MODEL, 'No model found for record for %s, API: %s, UWI: %s\n\t%s %s %s %s %s' % (
+                    rec.sta.state_code, rec.wb.api, rec.wb.uwi, rec.wbd.locnum, rec.coo.northing, rec.coo.easting, rec.coo.epsg_code, rec.geo.legal_desc),
+                    region='unmatched', state=rec.sta.state_code)
+            if incremental:
+                # only the records with a stored point are skipped by the next run
+                incremental.done(rec, stored=result is not None)
+            if checkpoint:
+                checkpoint.advance(rec.wbd.id, reported)
+            metrics.tick()
+
+    return i, j, results
+
+
+def process_partition(task):
+    """
+        worker process: runs the pipeline for one WellBoreDetail id range, task = (filters, (first id, last id), order), with its own session;
+        returns the id range, the results of process_records, the metrics of the partition
+        and the fingerprints of its processed records in incremental runs
+    """
+    filters, (first_id, last_id), order = task
+    metrics.reset_metrics()
+    session = rigdata21_session_maker()
+    try:
+        query = build_query(session, filters).filter(WellBoreDetail.id.between(first_id, last_id))
+        results = process_records(stream_rows(session, query, record_ids(query, order), order))
+        fingerprints = get_incremental().take() if get_incremental() else []
+        return ((first_id, last_id),) + results + (metrics.get_metrics().state(), fingerprints)
+    finally:
+        # the corners added by the worker are committed, the other workers can write to the index
+        if get_corner_index():
+            get_corner_index().commit()
+        session.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='calculates the coordinates of the wells from their legal descriptions')
+    parser.add_argument('--states', nargs='+', default=DEFAULT_FILTERS['states'], help='state / province codes')
+    parser.add_argument('--posted-after', default=DEFAULT_FILTERS['posted_after'], help='permit posted after the date (YYYY-MM-DD)')
+    parser.add_argument('--posted-before', default=DEFAULT_FILTERS['posted_before'], help='permit posted before the date (YYYY-MM-DD)')
+    parser.add_argument('--wellpoint-type', type=int, default=DEFAULT_FILTERS['wellpoint_type'], help='WellPointTypeID')
+    parser.add_argument('--first-id', type=int, default=DEFAULT_FILTERS['first_id'], help='first WellBoreDetailID')
+    parser.add_argument('--last-id', type=int, default=DEFAULT_FILTERS['last_id'], help='last WellBoreDetailID')
+    parser.add_argument('--limit', type=int, default=None, help='number of records processed, e.g. for a test run')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--commit', dest='commit', action='store_true', default=COMMIT, help='commit the calculated points')
+    mode.add_argument('--dry-run', dest='commit', action='store_false', help='roll the calculated points back (default)')
+    parser.add_argument('--checkpoint', default=None, help='checkpoint file of the run, an existing checkpoint of the same filters is resumed')
+    parser.add_argument('--incremental', default=None, help='fingerprint file of the stored points, only new and changed records are processed')
+    parser.add_argument('--processes', type=int, default=PROCESSES, help='number of worker processes')
+    parser.add_argument('--lookup-threads', type=int, default=LOOKUP_THREADS, help='number of reference shape lookup threads')
+    parser.add_argument('--mirror', default=GIS_MIRROR, help='local mirror of the reference layers')
+    parser.add_argument('--corner-index', default=CORNER_INDEX, help='four-corner index of the reference polygons')
+    parser.add_argument('--metrics-json', default=METRICS_JSON, help='file the metrics are dumped to as JSON')
+    parser.add_argument('--metrics-prometheus', default=METRICS_PROMETHEUS, help='file the metrics are dumped to in the Prometheus text format')
+    parser.add_argument('--progress', type=float, default=PROGRESS_INTERVAL, help='seconds between the progress lines')
+    parser.add_argument('--order', choices=('id', 'reference'), default=ORDER,
+                        help='process the records by WellBoreDetail id or grouped by their reference polygon (within the partitions of parallel runs); '
+                             'the reference order is on unindexed Geography columns, the server sorts all the ids of the run before the first chunk is read')
+    parser.add_argument('--memo-size', type=int, default=RESULT_MEMO_SIZE, help='results memoized per legal description, 0 disables the memo')
+    args = parser.parse_args(argv)
+
+    # a serial checkpoint records the completed id ranges, the records have to come in id order
+    if args.checkpoint and args.order != 'id' and args.processes <= 1:
+        parser.error('--checkpoint of a serial run needs --order id')
+
+    for date in (args.posted_after, args.posted_before):
+        if date:
+            try:
+                parse_date(date)
+            except ValueError:
+                parser.error('invalid date: %s' % date)
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    filters = {
+        'states'         : [state.upper() for state in args.states] if args.states else None,
+        'posted_after'   : args.posted_after,
+        'posted_before'  : args.posted_before,
+        'wellpoint_type' : args.wellpoint_type,
+        'first_id'       : args.first_id,
+        'last_id'        : args.last_id,
+    }
+
+    configure_result_memo(args.memo_size)
+    if args.mirror:
+        set_backend(Mirror(args.mirror))
+    if args.corner_index:
+        set_corner_index(CornerIndex(args.corner_index))
+        # an index of another version is refused before the run starts
+        get_corner_index().connect()
+    # the lookup threads and the main thread each hold a connection
+    configure_pool(max(GIS_POOL_SIZE, args.lookup_threads + 1), GIS_POOL_TIMEOUT, GIS_POOL_RECYCLE)
+
+    incremental = None
+    if args.incremental:
+        incremental = Incremental(FingerprintStore(args.incremental))
+        set_incremental(incremental)
+        if not args.commit:
+            print 'dry run: the fingerprints of the processed records are not saved'
+
+    checkpoint = None
+    if args.checkpoint:
+        checkpoint = Checkpoint(args.checkpoint, filters)
+        if checkpoint.load():
+            print 'resuming from %s: %i records processed before, %i id ranges completed' % (args.checkpoint, checkpoint.processed, len(checkpoint.ranges))
+        if not args.commit:
+            print 'dry run: the checkpoint is not advanced'
+
+    session = rigdata21_session_maker()
+    query = build_query(session, filters)
+
+    def on_commit():
+        # the checkpoint advances and the fingerprints are saved as the written points are committed,
+        # the rolled back transactions of a dry run cover nothing
+        if checkpoint and args.commit:
+            checkpoint.commit()
+        if incremental and args.commit:
+            incremental.commit()
+
+    # the calculated points are written back in batches on a separate connection
+    writer = BulkWriter(engine_RigData21, WRITE_BATCH_SIZE, WRITE_COMMIT_INTERVAL, WRITE_METHOD, args.commit,
+                        on_commit if args.processes <= 1 else None)
+
+    if args.processes > 1:
+        # partition the WellBoreDetail ids into ranges processed by the worker processes
+        ids = record_ids(query, 'id', args.limit)
+        if checkpoint:
+            ids = [_id for _id in ids if not checkpoint.done(_id)]
+        partitions = partition_keys(ids, CHUNK_SIZE)
+        if args.progress:
+            metrics.start_progress(len(ids), args.progress)
+
+        i, j = 0, 0
+        tasks = [(filters, bounds, args.order) for bounds in partitions]
+        for bounds, processed, reported, results, partition_metrics, fingerprints in run_parallel(process_partition, tasks, args.processes, [engine_RigData21]):
+            i += processed
+            j += reported
+            metrics.get_metrics().merge(partition_metrics)
+            metrics.tick(processed)
+            with timer('write'):
+                for result in results:
+                    writer.add_result(result)
+                if checkpoint or incremental:
+                    # the partition is completed once its results are written
+                    writer.flush()
+                    writer.end_transaction()
+            if checkpoint and args.commit:
+                checkpoint.add_range(*bounds)
+                checkpoint.processed += processed
+                checkpoint.reported += reported
+                checkpoint.save()
+            if incremental and args.commit:
+                incremental.commit(fingerprints)
+    else:
+        pipeline = None
+        if args.lookup_threads and not args.mirror:
+            pipeline = LookupPipeline(args.lookup_threads, LOOKUP_WINDOW, corners.HULL_TOLERANCE)
+            pipeline.start()
+        records_query = query
+        if checkpoint:
+            records_query = checkpoint.exclude(records_query, WellBoreDetail.id)
+        ids = record_ids(records_query, args.order, args.limit)
+        if args.progress:
+            metrics.start_progress(len(ids), args.progress)
+        try:
+            i, j, results = process_records(stream_rows(session, records_query, ids, args.order), writer, pipeline, checkpoint)
+        finally:
+            if pipeline:
+                pipeline.close()
+        if pipeline:
+            print 'lookup pipeline: %(threads)i threads, %(fetched)i lookups fetched, %(failed)i failed' % pipeline.stats()
+
+    with timer('write'):
+        written = writer.close()
+    if checkpoint and args.commit:
+        checkpoint.finish()
+    if incremental:
+        # the records processed after the last transaction of the writer
+        if args.commit:
+            incremental.commit()
+        incremental.close()
+        print '%i unchanged records skipped.' % metrics.get_metrics().total('unchanged_records')
 
     print '%i total records reported.' % j
     print '%i total records processed.' % i
-    # commits the changes into the database
-    # session.commit()
-
+    print '%i calculated points %s.' % (written, 'written' if args.commit else 'written and rolled back (dry run)')
+    print 'reference geometry cache: %(entries)i entries, %(hits)i hits, %(misses)i misses, %(evictions)i evictions' % get_geometry_cache().stats()
+    print 'prepared QA shapes: %(entries)i entries, %(hits)i hits, %(misses)i misses' % get_quality_engine().stats()
+    if get_result_memo():
+        print 'result memo: %(entries)i legal descriptions, %(hits)i hits, %(misses)i misses' % get_result_memo().stats()
+    if pool_stats():
+        print 'GIS connection pool: %(open)i of %(size)i connections open, peak %(peak)i checked out, %(checkouts)i checkouts, %(invalidated)i invalidated' % pool_stats()
+    if get_corner_index():
+        print 'corner index: %(hits)i hits, %(misses)i misses' % get_corner_index().stats()
+        get_corner_index().close()
+    metrics.get_metrics().report()
+    metrics.get_metrics().dump(args.metrics_json, args.metrics_prometheus)
+    session.close()
@@ -1,14 +1,14 @@
-import pymssql
 import math
-import heapq
 import pyproj
+import numpy as np
+from collections import OrderedDict
 import shapely
 from shapely.geometry import Point, LineString
 from shapely.wkt import dumps, loads
 from pyparsing import commaSeparatedList
 
-conn_read  = pymssql.connect(host='RDSQLDEV\\RDSQLDEV')
-cur_read = conn_read.cursor()
+import metrics
+from metrics import timed
 
 
 class UnitsException(Exception): pass
@@ -100,7 +100,7 @@ def meridian_zone (state_code, county_name, twnshp, twnshp_dir, range_, range_di
 
 
     else:
-        print 'Unhadled dual meridian zone for county: %s, %s' % (state_code, county_name)
+        metrics.outcome(metrics.UNHANDLED_MERIDIAN, 'Unhadled dual meridian zone for county: %s, %s' % (state_code, county_name))
 
 
 def extend_line (line_string, distance):
@@ -110,17 +110,64 @@ def extend_line (line_string, distance):
     return LineString([p3, p4])
 
 
-def transform (epsg_in, epsg_out, point_in):
-    # define source and destination coordinate systems based on the ESPG code
-    srcProj = pyproj.Proj(init='epsg:%i' % epsg_in, preserve_units=True)
-    dstProj = pyproj.Proj(init='epsg:%i' % epsg_out, preserve_units=True)
+class Transformer():
+    """
+        prebuilt pair of source and destination projections for one (epsg_in, epsg_out) combination
+
+    """
+    def __init__(self, epsg_in, epsg_out):
+        self.epsg_in = epsg_in
+        self.epsg_out = epsg_out
+
+        # define source and destination coordinate systems based on the ESPG code
+        self.srcProj = pyproj.Proj(init='epsg:%i' % epsg_in, preserve_units=True)
+        self.dstProj = pyproj.Proj(init='epsg:%i' % epsg_out, preserve_units=True)
+
+    def transform_xy(self, x, y):
+        # x and y can be scalars or sequences/arrays of equal length (batch reprojection)
+        return pyproj.transform(self.srcProj, self.dstProj, x, y)
+
+    def transform_point(self, point_in):
+        return Point(self.transform_xy(point_in.x, point_in.y))
+
+    def transform_points(self, points_in):
+        if not points_in:
+            return []
+        xs, ys = self.transform_xy([pnt.x for pnt in points_in], [pnt.y for pnt in points_in])
+        return [Point(x, y) for x, y in zip(xs, ys)]
+
+
+# process-wide registry of transformers, keyed by (epsg_in, epsg_out)
+_transformers = {}
+
+
+def get_transformer (epsg_in, epsg_out):
+    key = (int(epsg_in), int(epsg_out))
+    transformer = _transformers.get(key)
+    if transformer is None:
+        transformer = _transformers[key] = Transformer(*key)
+    return transformer
+
 
+def transform (epsg_in, epsg_out, point_in):
     # performes transformation
-    point_out = Point(pyproj.transform(srcProj, dstProj, point_in.x, point_in.y))
+    point_out = get_transformer(epsg_in, epsg_out).transform_point(point_in)
     # print '(%.5f, %.5f) EPSG: %i => (%.5f, %.5f) EPSG: %i' % (x_in, y_in, epsg_in, x_out, y_out, epsg_out)
     return point_out
 
 
+def transform_xy (epsg_in, epsg_out, x, y):
+    """
+        batch version of transform: x and y are scalars or sequences/arrays of coordinates,
+        returns the transformed (x, y) in the same form
+    """
+    return get_transformer(epsg_in, epsg_out).transform_xy(x, y)
+
+
+def transform_points (epsg_in, epsg_out, points_in):
+    return get_transformer(epsg_in, epsg_out).transform_points(points_in)
+
+
 def ft2m (feet):
     return feet * 0.3048
 
@@ -169,11 +216,12 @@ def rules (_dir, four_points):
         elif _dir =='FSWL':
             return LineString([point_S, point_W])
     else:
-        print '\tUnknown direction: %s' % _dir
+        metrics.outcome(metrics.UNKNOWN_DIRECTION, '\tUnknown direction: %s' % _dir)
         # raise DirectionException('Unknown _direction: %s' % _dir)
         return None
 
 
+@timed('calc_point_from_offsets')
 def calc_point_from_offsets (four_corners_wm, dist1, dir1, dist2, dir2, units='feet'):
 
     if not units.lower() in ('feet', 'meters'):
@@ -195,7 +243,7 @@ def calc_point_from_offsets (four_corners_wm, dist1, dir1, dist2, dir2, units='f
     # print line2
 
     if not (all([line1, line2]) and all([line1.length, line2.length])): 
-        print '\tcould not resolve offset lines.'
+        metrics.outcome(metrics.UNRESOLVED_OFFSET_LINES, '\tcould not resolve offset lines.')
         return None
 
     # print 'd1: %.1f, d2: %.1f' % (dist1, dist2)
@@ -213,18 +261,107 @@ def calc_point_from_offsets (four_corners_wm, dist1, dir1, dist2, dir2, units='f
     pnt = offset_line1.intersection(offset_line2)
     if not pnt: 
         # extend both lines for 1000m
-        print'\tintersection not found, extending lines and re-intersecting...'
+        metrics.outcome(metrics.EXTENDED_INTERSECTION, '\tintersection not found, extending lines and re-intersecting...')
         offset_line1 = extend_line(offset_line1, 1000)
         offset_line2 = extend_line(offset_line2, 1000)
         
         pnt = offset_line1.intersection(offset_line2)
         if not pnt:
-            print'\tcould not resolve the intersection'
+            metrics.outcome(metrics.UNRESOLVED_INTERSECTION, '\tcould not resolve the intersection')
             return None
 
     return transform(3857, 4269, pnt)
 
 
+def offset_lines (four_corners_wm, directions):
+    """
+        returns {direction: (x1, y1, x2, y2)} of the lines the offsets are measured from,
+        None for the directions that could not be resolved
+    """
+    lines = {}
+    for _dir in set(directions):
+        line = rules(_dir, four_corners_wm)
+        lines[_dir] = line.coords[0] + line.coords[-1] if line and line.length else None
+    return lines
+
+
+def intersect_offset_lines (lines1, dist1, lines2, dist2, extension=1000.0):
+    """
+        closed form of parallel_offset(dist, 'right') + intersection for arrays of lines (n, 4) and distances (n,);
+        lines that do not intersect are extended by the extension on both ends (see extend_line)
+
+        returns x, y arrays, NaN where the offset lines do not intersect
+    """
+    def offset(lines, dist):
+        start = lines[:, 0:2]
+        direction = lines[:, 2:4] - start
+        length = np.hypot(direction[:, 0], direction[:, 1])
+        # right hand normal of the line direction
+        normal = np.column_stack((direction[:, 1], -direction[:, 0])) / length[:, None]
+        return start + normal * dist[:, None], direction, length
+
+    p, r, length1 = offset(lines1, dist1)
+    q, s, length2 = offset(lines2, dist2)
+
+    # p + t * r = q + u * s
+    denominator = r[:, 0] * s[:, 1] - r[:, 1] * s[:, 0]
+    qp = q - p
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (qp[:, 0] * s[:, 1] - qp[:, 1] * s[:, 0]) / denominator
+        u = (qp[:, 0] * r[:, 1] - qp[:, 1] * r[:, 0]) / denominator
+        ext1 = extension / length1
+        ext2 = extension / length2
+
+        # parallel lines give NaN/inf parameters and are never found
+        found = (t >= -ext1) & (t <= 1 + ext1) & (u >= -ext2) & (u <= 1 + ext2)
+        x = np.where(found, p[:, 0] + t * r[:, 0], np.nan)
+        y = np.where(found, p[:, 1] + t * r[:, 1], np.nan)
+    return x, y
+
+
+@timed('calc_points_from_offsets')
+def calc_points_from_offsets (four_corners_wm, dist1, dir1, dist2, dir2, units='feet'):
+    """
+        batch version of calc_point_from_offsets for many wells referencing the same four corners:
+        dist1, dir1, dist2, dir2 (and optionally units) hold one value per well
+
+        returns (lon, lat) arrays of the NAD83 points, NaN where the point could not be calculated
+    """
+    dist1 = np.asarray(dist1, dtype=float)
+    dist2 = np.asarray(dist2, dtype=float)
+    units = np.array([units] * len(dist1) if isinstance(units, basestring) else units)
+
+    for _units in set(units):
+        if not _units.lower() in ('feet', 'meters'):
+            raise UnitsException('Unknown units: %s' % _units)
+
+    dir1 = [_dir.upper() for _dir in dir1]
+    dir2 = [_dir.upper() for _dir in dir2]
+
+    # one web mercator distance correction factor for the whole corner set
+    centroid_wm = Point(avg(pnt.x for pnt in four_corners_wm), avg(pnt.y for pnt in four_corners_wm))
+    centroid_nad83 = transform(3857, 4269, centroid_wm)
+    wm_corr_factor = math.cos(centroid_nad83.y * math.pi / 180.0)
+
+    feet = units == 'feet'
+    dist1 = np.where(feet, ft2m(dist1), dist1) / wm_corr_factor
+    dist2 = np.where(feet, ft2m(dist2), dist2) / wm_corr_factor
+
+    lines = offset_lines(four_corners_wm, dir1 + dir2)
+    unresolved = (np.nan,) * 4
+    lines1 = np.array([lines[_dir] or unresolved for _dir in dir1], dtype=float).reshape(-1, 4)
+    lines2 = np.array([lines[_dir] or unresolved for _dir in dir2], dtype=float).reshape(-1, 4)
+
+    x, y = intersect_offset_lines(lines1, dist1, lines2, dist2)
+
+    lon = np.full(len(x), np.nan)
+    lat = np.full(len(x), np.nan)
+    found = ~np.isnan(x)
+    if found.any():
+        lon[found], lat[found] = transform_xy(3857, 4269, x[found], y[found])
+    return lon, lat
+
+
 def area ( poly_geometry_wm, units='hectars' ):
     """
         returns area in hectars of the polygon geometry
@@ -249,24 +386,6 @@ def bearing_deg (pnt1, pnt2):
     return math.atan2(pnt2.x-pnt1.x, pnt2.y-pnt1.y) * 180.0 / math.pi
 
 
-def queryWKT (table, where_clause, cursor=cur_read ):
-
-    select_statement = 'SELECT  geom.STAsText() FROM %s WHERE %s' % (table, where_clause)
-    # print select_statement
-    cursor.execute(select_statement)
-    row = cursor.fetchone()
-    # print row
-    while row:
-        # print row[0]
-        row1 = cursor.fetchone()
-        if row1: 
-            print '\tmore than one polygon returned from the statement: %s' % select_statement
-            return None
-        return row[0]
-    print '\tno record returned based on statement: %s' % select_statement
-    return None
-
-
 def avg (values):
     sum1 = 0.0
     n=0
@@ -277,87 +396,78 @@ def avg (values):
 
 
 class CornerDetector():
+    # polygon_WKT can also be an already parsed (shapely) polygon
     def __init__(self, polygon_WKT):
         self.polygon_WKT = polygon_WKT
         self.poly = None
-        self.points = None
+        self.coords = None     # (n, 2) array of the hull vertices
         self.four_corners = None
         self.calc_four_corners()
 
     def parseWKT(self):
         # example of self.polygonWKT:
         # "POLYGON ((-10626837.21794926 3757110.4207815621, -10626540.482634166 3757112.4199904846, -10626540.670118278 3757600.8320014365, -10628182.246195693 3757573.3814624925, -10628174.337145651 3757112.1032040166, -10626837.21794926 3757110.4207815621))"
-        poly = loads(self.polygon_WKT)
+        poly = loads(self.polygon_WKT) if isinstance(self.polygon_WKT, basestring) else self.polygon_WKT
 
         #create a convex hull in order to take care of irregular shapes
         self.poly = poly.convex_hull
 
-        self.set_points([Point(pnt) for pnt in self.poly.exterior.coords])
+        self.set_coords(np.asarray(self.poly.exterior.coords, dtype=float)[:, :2])
 
     def remove_duplicate_points(self):
-        unique_points = [self.points[0]]
-
-        for pnt in self.points:
-            unique = True
-            for uni_pnt in unique_points:
-                if pnt.x == uni_pnt.x and pnt.y == uni_pnt.y:
-                    unique = False
-            if unique:
-                unique_points.append(pnt)
-        #print '#points: %i, #no dups: %i' % (len(self.points), len(unique_points))
-        self.points = unique_points
+        # keeps the first occurrence of every vertex, in ring order (the closing vertex of the ring is a duplicate)
+        unique = OrderedDict.fromkeys(map(tuple, self.coords.tolist()))
+        #print '#points: %i, #no dups: %i' % (len(self.coords), len(unique))
+        self.coords = np.array(unique.keys(), dtype=float).reshape(-1, 2)
+
+    def get_coords(self):
+        return self.coords
+
+    def set_coords(self, coords):
+        self.coords = coords
 
     def get_points(self):
-        return self.points
+        return [Point(x, y) for x, y in self.coords]
 
     def set_points(self, points):
-        self.points = points
-
-    def internal_angle(self, currPoint, prevPoint, nextPoint):
-        try:
-            slope_currPoint_prevPoint = (prevPoint.y - currPoint.y)/(prevPoint.x - currPoint.x)
-        except ZeroDivisionError:
-            slope_currPoint_prevPoint = 99999
-        try:
-            slope_currPoint_nextPoint = (nextPoint.y - currPoint.y)/(nextPoint.x - currPoint.x)
-        except ZeroDivisionError:
-            slope_currPoint_nextPoint = 99999
-
-        acuteAngle = math.atan(abs((slope_currPoint_nextPoint - slope_currPoint_prevPoint)/(1 + slope_currPoint_nextPoint * slope_currPoint_prevPoint)))
-        #print 'Angle: %f' % acuteAngle
-        return acuteAngle
-
+        self.coords = np.array([(pnt.x, pnt.y) for pnt in points], dtype=float).reshape(-1, 2)
+
+    def slopes(self, coords, other):
+        dx = other[:, 0] - coords[:, 0]
+        dy = other[:, 1] - coords[:, 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = dy / dx
+        slope[dx == 0] = 99999
+        return slope
+
+    def internal_angles(self, coords):
+        """
+            acute angle between the edges to the previous and to the next vertex, for every vertex of the ring
+        """
+        slope_prev = self.slopes(coords, np.roll(coords, 1, axis=0))
+        slope_next = self.slopes(coords, np.roll(coords, -1, axis=0))
+
+        # perpendicular edges (denominator 0) give the right angle
+        with np.errstate(divide='ignore', invalid='ignore'):
+            acuteAngles = np.arctan(np.abs((slope_next - slope_prev) / (1 + slope_next * slope_prev)))
+        #print 'Angles: %s' % acuteAngles
+        return acuteAngles
+
+    @timed('corner_detector')
     def calc_four_corners(self):
         self.parseWKT()
         self.remove_duplicate_points()
 
         ## degugging
         #print ' points:'
-        #for pnt in self.get_points():
-        #    print 'x:%.8f, y: %.8f' % (pnt.X, pnt.Y)
-
-        _angles = []
-        _points = self.get_points()
-        for pnt in _points:
-            curr_point = pnt
-            try:
-                prev_point = _points[_points.index(pnt) - 1]
-            except:
-                prev_point = _points[-1] # get the last point in the list
-
-            try:
-                next_point = _points[_points.index(pnt) + 1]
-            except:
-                next_point = _points[0] # get the first point in the list
-
-            _angle = self.internal_angle(pnt, prev_point, next_point)
-            #print 'angle: ', _angle
-            _angles.append(_angle)
-
-        # get the four largest internal angles
-        four_largest_angles = heapq.nlargest(4, enumerate(_angles), key=lambda x: x[1])
-        indices_of_four_largest_angles = [i[0] for i in four_largest_angles]
-        four_points = [_points[i] for i in indices_of_four_largest_angles]
+        #for x, y in self.get_coords():
+        #    print 'x:%.8f, y: %.8f' % (x, y)
+
+        _angles = self.internal_angles(self.coords)
+
+        # get the four largest internal angles (stable sort: on ties the vertex first in the ring wins)
+        indices_of_four_largest_angles = np.argsort(-_angles, kind='mergesort')[:4]
+        four_points = [Point(*self.coords[i]) for i in indices_of_four_largest_angles]
         # print four_points
         # define NE, SE, SW and NW corner
         # pnt_centroid = self.poly.centroid
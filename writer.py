@@ -0,0 +1,107 @@
+from collections import OrderedDict
+from sqlalchemy import text
+
+
+class WriterException(Exception): pass
+
+
+class BulkWriter():
+    """
+        collects the calculated points (CoordinateID, northing, easting, epsg_code, loc_quality)
+        and writes them back to CoordinateData in batches, on its own connection
+
+        method          : 'executemany' (one parameterized UPDATE executed for the whole batch)
+                          or 'merge' (batch loaded into a staging table and merged with one statement)
+        batch_size      : number of rows written together
+        commit_interval : number of batches per transaction
+        commit          : False rolls the transactions back (dry run)
+        on_commit       : called whenever a transaction is ended, e.g. to advance a checkpoint (see checkpoint.py)
+    """
+
+    update_statement = text('UPDATE CoordinateData SET Northing = :northing, Easting = :easting, EPSGCode = :epsg_code, LocQuality = :loc_quality '
+                            'WHERE CoordinateID = :coordinate_id')
+
+    def __init__(self, engine, batch_size=1000, commit_interval=10, method='executemany', commit=False, on_commit=None):
+        if method not in ('executemany', 'merge'):
+            raise WriterException('Unknown write method: %s' % method)
+
+        self.engine = engine
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.method = method
+        self.commit = commit
+        self.on_commit = on_commit
+
+        self.rows = []
+        self.batches = 0    # batches written in the current transaction
+        self.written = 0
+        self.connection = None
+        self.transaction = None
+
+    def add(self, coordinate_id, northing, easting, epsg_code, loc_quality):
+        self.rows.append((coordinate_id, northing, easting, epsg_code, loc_quality))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def add_result(self, result):
+        # result tuple of LegalDescription.get_result
+        wbd_id, coordinate_id, lon, lat, epsg_code, loc_quality = result
+        self.add(coordinate_id, lat, lon, epsg_code, loc_quality)
+
+    def flush(self):
+        if not self.rows:
+            return
+
+        if self.connection is None:
+            self.connection = self.engine.connect()
+        if self.transaction is None:
+            self.transaction = self.connection.begin()
+
+        if self.method == 'executemany':
+            self.connection.execute(self.update_statement, [
+                {'coordinate_id': row[0], 'northing': row[1], 'easting': row[2], 'epsg_code': row[3], 'loc_quality': row[4]}
+                for row in self.rows])
+        else:
+            self.merge(self.rows)
+
+        self.written += len(self.rows)
+        self.rows = []
+        self.batches += 1
+        if self.batches >= self.commit_interval:
+            self.end_transaction()
+
+    def merge(self, rows):
+        # a coordinate can be calculated more than once (one row per permit), the last value wins like with the UPDATEs
+        rows = OrderedDict((row[0], row) for row in rows).values()
+
+        self.connection.execute(text("IF OBJECT_ID('tempdb..#coordinate_staging') IS NOT NULL DROP TABLE #coordinate_staging"))
+        self.connection.execute(text('CREATE TABLE #coordinate_staging (CoordinateID INT PRIMARY KEY, Northing FLOAT, Easting FLOAT, EPSGCode INT, LocQuality FLOAT)'))
+
+        # SQL Server accepts up to 1000 rows in one VALUES list
+        for i in range(0, len(rows), 1000):
+            values = ', '.join('(%i, %r, %r, %i, %r)' % (int(row[0]), float(row[1]), float(row[2]), int(row[3]), float(row[4])) for row in rows[i:i + 1000])
+            self.connection.execute(text('INSERT INTO #coordinate_staging VALUES %s' % values))
+
+        self.connection.execute(text(
+            'MERGE CoordinateData AS c USING #coordinate_staging AS s ON c.CoordinateID = s.CoordinateID '
+            'WHEN MATCHED THEN UPDATE SET Northing = s.Northing, Easting = s.Easting, EPSGCode = s.EPSGCode, LocQuality = s.LocQuality;'))
+        self.connection.execute(text('DROP TABLE #coordinate_staging'))
+
+    def end_transaction(self):
+        if self.transaction is not None:
+            if self.commit:
+                self.transaction.commit()
+            else:
+                self.transaction.rollback()
+            self.transaction = None
+            if self.on_commit:
+                self.on_commit()
+        self.batches = 0
+
+    def close(self):
+        self.flush()
+        self.end_transaction()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        return self.written